@@ -30,17 +30,41 @@
 # SOFTWARE.
 # */
 
+import os
+import re
+import hashlib
+import tempfile
 from StringIO import StringIO
 
 def jsmin(js):
-    ins = StringIO(js)
-    outs = StringIO()
-    JavascriptMinify().minify(ins, outs)
-    str = outs.getvalue()
+    str = FastJavascriptMinify().minify_string(js)
     if len(str) > 0 and str[0] == '\n':
         str = str[1:]
     return str
 
+def jsmin_iter(chunks):
+    """yield what jsmin would return for the javascript in the iterable
+       chunks, a piece at a time. Chunks are only read as they're needed,
+       so the whole script is never held in memory.
+    """
+    lead = True
+    for piece in FastJavascriptMinify().minify_iter(chunks):
+        if lead and piece:
+            lead = False
+            if piece[0] == '\n':
+                piece = piece[1:]
+        if piece:
+            yield piece
+
+def read_blocks(path, size=64 * 1024):
+    """yield the content of the file at path a block at a time"""
+    f = open(path, 'rb')
+    try:
+        for block in iter(lambda: f.read(size), ''):
+            yield block
+    finally:
+        f.close()
+
 def isAlphanum(c):
     """return true if the character is a letter, digit, underscore,
            dollar sign, or non-ASCII character.
@@ -212,7 +236,907 @@ class JavascriptMinify(object):
         self._jsmin()
         self.instream.close()
 
+# what JavascriptMinify._get makes of each character: control characters
+# become spaces, except carriage returns, which become linefeeds
+control_chars = dict([(i, u' ') for i in range(32)])
+control_chars[10] = u'\n'
+control_chars[13] = u'\n'
+control_table = ''.join([chr(i) if i >= 32 else str(control_chars[i])
+                         for i in range(256)])
+# tables for the tests JavascriptMinify makes a character at a time
+alphanum = frozenset('abcdefghijklmnopqrstuvwxyz0123456789'
+                     'ABCDEFGHIJKLMNOPQRSTUVWXYZ_$\\')
+regex_prefix = frozenset('(,=:[?!&|;{}\n')
+newline_keepers = frozenset('}])+-"\'')
+newline_keep_before = frozenset('{[(+-')
+# runs of characters that are copied to the output as they are
+plain_run = re.compile(r'''[^ \n'"/]+''')
+space_run = re.compile(' +')
+string_special = {'"': re.compile(r'["\\\n]'),
+                  "'": re.compile(r"['\\\n]")}
+regex_special = re.compile(r'[/\\\n]')
+
+class FastJavascriptMinify(object):
+    """Does what JavascriptMinify does, with the same output, but works on
+       blocks of input rather than a character at a time. Control characters
+       are translated a block at a time, characters are looked up by index
+       and classified with tables, and runs that need no decisions (strings,
+       regular expressions, comments, identifiers and spaces) are copied or
+       skipped a slice at a time. Only the block being worked on, and the
+       odd character of lookahead, is held in memory.
+    """
+    # characters read at a time by minify
+    chunk_size = 64 * 1024
+
+    def _fill(self, s, i, need):
+        """return what's left of s from index i, with more input added until
+           it's need characters long or the input runs out, and its index.
+        """
+        s = s[i:]
+        while len(s) < need:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self.more = False
+                break
+            if isinstance(chunk, unicode):
+                s += chunk.translate(control_chars)
+            else:
+                s += chunk.translate(control_table)
+        return s, 0
+
+    def _next(self, s, i, a):
+        """return the next character after index i, excluding comments, the
+           index after it and the input, like JavascriptMinify._next.
+        """
+        if i + 1 >= len(s) and self.more:
+            s, i = self._fill(s, i, 2)
+        if i >= len(s):
+            return '\000', i + 1, s
+        c = s[i]
+        i += 1
+        if c == '/' and a != '\\':
+            if i == len(s):
+                # JavascriptMinify peeks past the end here, and then reads
+                # the end of the input as a space
+                return c, i, s + ' '
+            p = s[i]
+            if p == '/':
+                end = s.find('\n', i + 1)
+                while end == -1 and self.more:
+                    s, i = self._fill(s, len(s), 1)
+                    end = s.find('\n', i)
+                if end == -1:
+                    return '\000', len(s) + 1, s
+                return '\n', end + 1, s
+            if p == '*':
+                start = i + 1
+                end = s.find('*/', start)
+                while end == -1 and self.more:
+                    # keep a last '*' that may start the end of the comment
+                    start = max(start, len(s) - 1)
+                    s, start = self._fill(s, start, len(s) - start + 1)
+                    end = s.find('*/', start)
+                if end == -1:
+                    raise UnterminatedComment()
+                return ' ', end + 2, s
+        return c, i, s
+
+    def minify_string(self, js):
+        """return the minified js, including any leading linefeed, like
+           JavascriptMinify.minify.
+        """
+        return ''.join(self.minify_iter([js]))
+
+    def minify_iter(self, chunks):
+        """yield the minified javascript in the iterable chunks, including
+           any leading linefeed, a piece at a time.
+        """
+        self.chunks = iter(chunks)
+        self.more = True
+        s = ''
+        out = []
+        write = out.append
+        a = '\n'
+        i = 0
+        action = 3
+        b = None
+        while True:
+            if len(out) > 1024:
+                yield ''.join(out)
+                del out[:]
+            if action <= 1:
+                write(a)
+            if action <= 2:
+                a = b
+                if a == '"' or a == "'":
+                    write(a)
+                    special = string_special[a]
+                    while True:
+                        m = special.search(s, i)
+                        if m is None:
+                            if not self.more:
+                                raise UnterminatedStringLiteral()
+                            write(s[i:])
+                            s, i = self._fill(s, len(s), 1)
+                            continue
+                        end = m.start()
+                        write(s[i:end])
+                        c = s[end]
+                        i = end + 1
+                        if c == a:
+                            break
+                        if i >= len(s) and self.more:
+                            s, i = self._fill(s, i, 1)
+                        if c == '\n' or i >= len(s):
+                            raise UnterminatedStringLiteral()
+                        write(c)
+                        write(s[i])
+                        i += 1
+            b, i, s = self._next(s, i, a)
+            if b == '/' and a in regex_prefix:
+                write(a)
+                write(b)
+                while True:
+                    m = regex_special.search(s, i)
+                    if m is None:
+                        if not self.more:
+                            raise UnterminatedRegularExpression()
+                        write(s[i:])
+                        s, i = self._fill(s, len(s), 1)
+                        continue
+                    end = m.start()
+                    write(s[i:end])
+                    c = s[end]
+                    i = end + 1
+                    if c == '/':
+                        break
+                    if i >= len(s) and self.more:
+                        s, i = self._fill(s, i, 1)
+                    if c == '\n' or i >= len(s):
+                        raise UnterminatedRegularExpression()
+                    write(c)
+                    write(s[i])
+                    i += 1
+                a = '/'
+                b, i, s = self._next(s, i, a)
+
+            if a == '\000':
+                break
+            # decide what to do next, as JavascriptMinify._jsmin does,
+            # taking whole runs of the easy cases at once
+            action = None
+            while action is None:
+                if b == ' ':
+                    if a == ' ' or a == '\n' or \
+                            not (a in alphanum or a > '~'):
+                        # each of these spaces would be deleted in turn
+                        m = space_run.match(s, i)
+                        if m:
+                            i = m.end()
+                        if a == ' ':
+                            action = 2
+                        else:
+                            action = 3
+                    else:
+                        action = 1
+                elif a == ' ':
+                    if b in alphanum or b > '~':
+                        action = 1
+                    else:
+                        action = 2
+                elif a == '\n':
+                    if b in newline_keep_before or b in alphanum or b > '~':
+                        action = 1
+                    else:
+                        action = 2
+                elif b == '\n':
+                    if a in newline_keepers or a in alphanum or a > '~':
+                        action = 1
+                    else:
+                        action = 3
+                else:
+                    action = 1
+                    if b not in '"\'/\000':
+                        m = plain_run.match(s, i)
+                        if m:
+                            # each character would be output in turn, with
+                            # nothing to decide until the end of the run
+                            end = m.end()
+                            t = a + b + s[i:end]
+                            k = end - i
+                            write(t[:k])
+                            a = t[k]
+                            b = t[k + 1]
+                            i = end
+                            action = None
+        if out:
+            yield ''.join(out)
+
+    def minify(self, instream, outstream):
+        read = lambda: instream.read(self.chunk_size)
+        for piece in self.minify_iter(iter(read, '')):
+            outstream.write(piece)
+        instream.close()
+
+# strings, comments, whitespace, punctuation and everything else in CSS
+css_token = re.compile(r'''("(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')|(/\*.*?\*/)|(\s+)|([{};,>:()])|([^"'/\s{};,>:()]+|/)''', re.S)
+# no space is needed after these...
+css_no_space_after = '{};,>:('
+# ...or before these. Not before ':' (a :hover isn't a:hover) or '('
+# (and ( isn't and( in a media query)
+css_no_space_before = '{};,>)'
+
+def cssmin(css):
+    """return css with comments and unneeded whitespace removed. Strings are
+       left alone.
+    """
+    tokens = []
+    pos = 0
+    while pos < len(css):
+        m = css_token.match(css, pos)
+        if m is None:
+            raise UnterminatedStringLiteral()
+        if m.group(2) is None and css.startswith('/*', pos):
+            raise UnterminatedComment()
+        pos = m.end()
+        if m.group(2) or m.group(3):
+            # a comment separates tokens just like whitespace does
+            if tokens and tokens[-1] != ' ':
+                tokens.append(' ')
+        else:
+            tokens.append(m.group(0))
+
+    out = []
+    for i, token in enumerate(tokens):
+        if token == ' ':
+            if not out or i + 1 == len(tokens):
+                continue
+            if out[-1][-1] in css_no_space_after or \
+                    tokens[i + 1][0] in css_no_space_before:
+                continue
+        elif token == '}' and out and out[-1] == ';':
+            out.pop()
+        out.append(token)
+    return ''.join(out)
+
+# comments, blocks whose content must be kept as is, tags, whitespace and text
+html_token = re.compile(r'''(<!--.*?-->)|(<(pre|textarea|script|style)\b.*?</\3\s*>)|(<(?:"[^"]*"|'[^']*'|[^'">])*>)|(\s+)|([^<\s]+|<)''', re.S | re.I)
+
+def htmlmin(html):
+    """return html with comments removed and runs of whitespace in the text
+       collapsed to a single space. Tags, conditional comments and the content
+       of pre, textarea, script and style elements are left alone.
+    """
+    out = []
+    pos = 0
+    while pos < len(html):
+        m = html_token.match(html, pos)
+        if m.group(1) is None and html.startswith('<!--', pos):
+            raise UnterminatedComment()
+        pos = m.end()
+        if m.group(1):
+            if m.group(1).startswith('<!--[if') or \
+                                m.group(1).startswith('<!--<![endif]'):
+                out.append(m.group(1))
+        elif m.group(5):
+            if out and out[-1] != ' ':
+                out.append(' ')
+        else:
+            out.append(m.group(0))
+    return ''.join(out).strip()
+
+class CannotMangle(Exception):
+    pass
+
+# whitespace, comments, strings, names, numbers, punctuators and a '/' that
+# may start a regular expression. Anything else (template literals,
+# non-ASCII names...) is beyond what the mangler understands
+js_token = re.compile(r'''(\s+)|(//[^\n]*|/\*.*?\*/)|("(?:\\(?:\r\n|[\s\S])|[^"\\\n])*"|'(?:\\(?:\r\n|[\s\S])|[^'\\\n])*')|([A-Za-z_$][\w$]*)|(0[xX][\da-fA-F]+|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)|(>>>=|\.\.\.|===|!==|<<=|>>=|>>>|=>|==|!=|<=|>=|&&|\|\||\+\+|--|\+=|-=|\*=|%=|&=|\|=|\^=|<<|>>|[{}()\[\];,<>+\-*%&|^!~?:=.])|(/)''', re.S)
+js_regex = re.compile(r'/(?:\\.|\[(?:\\.|[^\]\\\n])*\]|[^/\\\n\[])+/[A-Za-z]*')
+# words that are never variables
+js_keywords = frozenset(['break', 'case', 'catch', 'continue', 'debugger',
+    'default', 'delete', 'do', 'else', 'false', 'finally', 'for', 'function',
+    'if', 'in', 'instanceof', 'new', 'null', 'return', 'switch', 'this',
+    'throw', 'true', 'try', 'typeof', 'var', 'void', 'while', 'with'])
+# words that mean the script is newer than the ES5 the mangler understands
+js_unsupported = frozenset(['class', 'const', 'enum', 'export', 'extends',
+    'import', 'let', 'super'])
+# and those that can't be used as names, for any version of javascript
+js_reserved = js_keywords | js_unsupported | frozenset(['abstract',
+    'arguments', 'await', 'boolean', 'byte', 'char', 'double', 'eval',
+    'final', 'float', 'goto', 'implements', 'int', 'interface', 'long',
+    'native', 'package', 'private', 'protected', 'public', 'short',
+    'static', 'synchronized', 'throws', 'transient', 'volatile', 'yield'])
+# keywords that an expression follows
+js_expression_keywords = frozenset(['case', 'delete', 'in', 'instanceof',
+    'new', 'return', 'throw', 'typeof', 'void'])
+
+def js_names():
+    """yield short names, shortest first"""
+    first = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_$'
+    rest = first + '0123456789'
+    names = list(first)
+    while True:
+        for name in names:
+            if name not in js_reserved:
+                yield name
+        names = [name + c for name in names for c in rest]
+
+class Scope(object):
+    """A function's variables and parameters, or a catch clause's, and what
+       they're renamed to.
+    """
+    def __init__(self, parent, catch=False):
+        self.parent = parent
+        self.catch = catch
+        # names declared here, and how often each is used
+        self.uses = {}
+        # (scope, name) of the variables used in this scope, or scopes
+        # inside it, that are declared further out
+        self.free = set()
+        self.renamed = {}
+        self.unsafe = False
+        self.children = []
+        if parent is not None:
+            parent.children.append(self)
+
+    def declare(self, name):
+        """declare name in the function this scope belongs to, returning
+           that function's scope.
+        """
+        scope = self
+        while scope.catch:
+            if name in scope.uses:
+                # var e inside catch (e) sets the exception but declares
+                # the function's variable
+                scope.unsafe = True
+            scope = scope.parent
+        scope.uses.setdefault(name, 0)
+        return scope
+
+class Frame(object):
+    """A bracket the mangler is inside, with what it knows about the
+       statement or expression there.
+    """
+    def __init__(self, kind, scope):
+        # 'block', 'object', '(' or '['
+        self.kind = kind
+        # the scope to go back to when the bracket closes
+        self.scope = scope
+        # in a var statement: 'name' before a variable, 'init' after one
+        self.var = None
+        # '?' and case waiting for their ':'
+        self.ternary = 0
+        self.case = 0
+        # in an object literal, whether a property name comes next
+        self.key = kind == 'object'
+        # whether this is a function's body
+        self.body = False
+
+class JavascriptMangler(object):
+    """Renames the parameters and local variables of functions in
+       javascript to short names, and leaves everything else as it is.
+       Globals, properties and object literal keys are never renamed, and
+       nor are the variables of a function that uses eval or with, or of
+       the functions around it, which that code can see by name. Each
+       function's names are chosen so they don't hide any variable from
+       further out that's used inside it.
+
+       Scripts are expected to be ES5. Raises CannotMangle for anything
+       that can't be understood well enough to be sure the renaming is
+       safe, including let, const, classes, arrow functions and template
+       literals.
+    """
+
+    def _tokenize(self, js):
+        """return the tokens of js as (kind, value, start, end, newline)
+           tuples, newline being whether a line break comes before the
+           token.
+        """
+        tokens = []
+        pos = 0
+        newline = False
+        # for each open paren, whether it's the head of an if, while, for
+        # or with, after which a / starts a regex rather than dividing
+        heads = []
+        head = False
+        while pos < len(js):
+            m = js_token.match(js, pos)
+            if m is None:
+                raise CannotMangle()
+            pos = m.end()
+            if m.group(1) or m.group(2):
+                newline = newline or '\n' in m.group(0) or \
+                          '\r' in m.group(0)
+                if m.group(0).startswith('/*') and not \
+                        m.group(0).endswith('*/'):
+                    raise CannotMangle()
+                continue
+            value = m.group(0)
+            if m.group(3):
+                kind = 'str'
+            elif m.group(4):
+                kind = 'name'
+            elif m.group(5):
+                kind = 'num'
+            elif m.group(6):
+                kind = 'punc'
+                if value == '(':
+                    prev = tokens and tokens[-1]
+                    heads.append(bool(prev) and prev[0] == 'name' and
+                                 prev[1] in ('if', 'while', 'for', 'with')
+                                 and not (len(tokens) > 1 and
+                                          tokens[-2][1] == '.'))
+                elif value == ')':
+                    if not heads:
+                        raise CannotMangle()
+                    head = heads.pop()
+            else:
+                prev = tokens and tokens[-1]
+                if not prev or (prev[0] == 'punc' and prev[1] not in
+                        (')', ']', '++', '--')) or (prev[1] == ')' and
+                        head) or (prev[0] == 'name' and
+                        prev[1] in js_expression_keywords | set(['do',
+                        'else'])):
+                    r = js_regex.match(js, m.start())
+                    if r is None:
+                        raise CannotMangle()
+                    kind, value, pos = 'regex', r.group(0), r.end()
+                else:
+                    kind = 'punc'
+                    if js.startswith('/=', m.start()):
+                        value = '/='
+                        pos += 1
+            tokens.append((kind, value, m.start(), pos, newline))
+            newline = False
+        return tokens
+
+    def _statement(self, prev, colon, newline):
+        """return whether a token after prev (and the kind of colon it is
+           if it's one) starts a statement, or None if it's hard to say.
+        """
+        if prev is None:
+            return True
+        kind, value = prev[0], prev[1]
+        if kind == 'punc':
+            if value in (';', '{', '}'):
+                return True
+            if value == ':':
+                return colon in ('label', 'case')
+            if value == ')':
+                return None
+            if value not in (']', '++', '--'):
+                return False
+        if kind == 'name':
+            if value == 'return':
+                return newline
+            if value in js_expression_keywords:
+                return False
+            if value in ('do', 'else', 'try', 'finally'):
+                return None
+        # a value then another expression means a semicolon was left out
+        return newline or None
+
+    def _function(self, k, scope, name_scope):
+        """parse the function whose name or parameter list starts at token
+           k, declaring its name in name_scope if it has one (or its own
+           scope if name_scope is None). Returns the function's scope and
+           the index of the token after its opening brace.
+        """
+        tokens = self.tokens
+        function = Scope(scope)
+        if tokens[k][0] == 'name':
+            if name_scope is None:
+                function.uses.setdefault(tokens[k][1], 0)
+                self.refs.append((k, function))
+            else:
+                name_scope.declare(tokens[k][1])
+                self.refs.append((k, scope))
+            k += 1
+        elif name_scope is not None:
+            raise CannotMangle()
+        if tokens[k][1] != '(':
+            raise CannotMangle()
+        k += 1
+        while tokens[k][1] != ')':
+            if tokens[k][0] != 'name' or tokens[k][1] in js_keywords or \
+                    tokens[k][1] in js_unsupported:
+                raise CannotMangle()
+            function.uses.setdefault(tokens[k][1], 0)
+            self.refs.append((k, function))
+            k += 1
+            if tokens[k][1] == ',':
+                k += 1
+            elif tokens[k][1] != ')':
+                raise CannotMangle()
+        if tokens[k + 1][1] != '{':
+            raise CannotMangle()
+        return function, k + 2
+
+    def _parse(self, js):
+        """work out the scopes of js and the names in each, filling in
+           self.tokens, self.root and self.refs (name tokens that are
+           variables, with the scope they're used in).
+        """
+        tokens = self._tokenize(js)
+        end = len(tokens)
+        # so there's always a token to look ahead to
+        self.tokens = tokens = tokens + [('end', None, 0, 0, True)] * 5
+        self.root = scope = Scope(None)
+        self.refs = refs = []
+        frames = [Frame('block', None)]
+        frames[0].body = True
+        prev = None
+        colon = None
+        k = 0
+        while k < end:
+            token = tokens[k]
+            kind, value, newline = token[0], token[1], token[4]
+            frame = frames[-1]
+            if frame.key:
+                # a property name in an object literal
+                following = tokens[k + 1][1]
+                if value == '}':
+                    frame.key = False
+                elif kind not in ('name', 'str', 'num'):
+                    raise CannotMangle()
+                elif following == ':':
+                    frame.key = False
+                    prev, colon = tokens[k + 1], 'object'
+                    k += 2
+                    continue
+                elif value in ('get', 'set') and \
+                        tokens[k + 1][0] in ('name', 'str', 'num'):
+                    # an accessor; its name is a property too
+                    frame.key = False
+                    function, k = self._function(k + 2, scope, None)
+                    frames.append(Frame('block', scope))
+                    frames[-1].body = True
+                    scope = function
+                    prev = tokens[k - 1]
+                    continue
+                else:
+                    raise CannotMangle()
+            if frame.var == 'init' and newline and kind in \
+                    ('name', 'num', 'str', 'regex') and (prev[0] != 'punc'
+                    or prev[1] in (')', ']', '}', '++', '--')):
+                # a semicolon was left out at the end of the var statement
+                frame.var = None
+            if kind == 'name':
+                if prev is not None and prev[1] == '.' and \
+                        prev[0] == 'punc':
+                    # a property
+                    pass
+                elif value in js_unsupported:
+                    raise CannotMangle()
+                elif value in js_keywords:
+                    if value == 'var':
+                        frame.var = 'name'
+                    elif value == 'function':
+                        statement = self._statement(prev, colon, newline)
+                        if statement is None or \
+                                tokens[k + 1][1] == '*':
+                            raise CannotMangle()
+                        if statement and not frame.body:
+                            # a function declared in a block is only seen
+                            # in that block by newer browsers
+                            scope.unsafe = True
+                        function, k = self._function(
+                            k + 1, scope, statement and scope or None)
+                        frames.append(Frame('block', scope))
+                        frames[-1].body = True
+                        scope = function
+                        prev = tokens[k - 1]
+                        continue
+                    elif value == 'catch':
+                        if [t[1] for t in tokens[k + 1:k + 5:2]] != \
+                                ['(', ')'] or tokens[k + 2][0] != 'name' \
+                                or tokens[k + 4][1] != '{':
+                            raise CannotMangle()
+                        catch = Scope(scope, catch=True)
+                        catch.uses[tokens[k + 2][1]] = 0
+                        refs.append((k + 2, catch))
+                        frames.append(Frame('block', scope))
+                        scope = catch
+                        prev = tokens[k + 4]
+                        k += 5
+                        continue
+                    elif value == 'with':
+                        scope.unsafe = True
+                    elif value in ('case', 'default'):
+                        frame.case += 1
+                    elif value in ('break', 'continue'):
+                        if tokens[k + 1][0] == 'name' and \
+                                not tokens[k + 1][4]:
+                            # a label
+                            k += 1
+                    elif value == 'in' and frame.var and frame.kind == '(':
+                        # for (var name in ...)
+                        frame.var = None
+                elif frame.var == 'name':
+                    scope.declare(value)
+                    refs.append((k, scope))
+                    frame.var = 'init'
+                elif tokens[k + 1][1] == ':' and frame.kind == 'block' \
+                        and not frame.ternary and not frame.case:
+                    # a label
+                    pass
+                else:
+                    if value == 'eval':
+                        scope.unsafe = True
+                    refs.append((k, scope))
+            elif kind == 'punc':
+                if value in ('=>', '...') or frame.var == 'name':
+                    # var [a, b] = ... and the like are beyond ES5 too
+                    raise CannotMangle()
+                elif value == '{':
+                    statement = self._statement(prev, colon, newline)
+                    frames.append(Frame(statement is False and 'object' or
+                                        'block', scope))
+                elif value in ('(', '['):
+                    frames.append(Frame(value, scope))
+                elif value in (')', ']', '}'):
+                    opening = {')': '(', ']': '[', '}': 'block'}[value]
+                    if len(frames) == 1 or \
+                            frame.kind.replace('object', 'block') != opening:
+                        raise CannotMangle()
+                    frames.pop()
+                    scope = frame.scope
+                elif value == ';':
+                    frame.var = None
+                elif value == ',':
+                    if frame.var:
+                        frame.var = 'name'
+                    if frame.kind == 'object':
+                        frame.key = True
+                elif value == '?':
+                    frame.ternary += 1
+                elif value == ':':
+                    if frame.ternary:
+                        frame.ternary -= 1
+                        colon = 'ternary'
+                    elif frame.case:
+                        frame.case -= 1
+                        colon = 'case'
+                    else:
+                        colon = 'label'
+            prev = token
+            k += 1
+        if len(frames) != 1:
+            raise CannotMangle()
+
+    def _resolve(self):
+        """find the scope each variable is declared in, counting how often
+           it's used and noting it as free in the scopes in between.
+        """
+        self.bindings = bindings = {}
+        for k, scope in self.refs:
+            name = self.tokens[k][1]
+            declared = scope
+            while declared is not self.root and name not in declared.uses:
+                declared = declared.parent
+            bindings[k] = declared
+            if declared is not self.root:
+                declared.uses[name] += 1
+            while scope is not declared:
+                scope.free.add((declared, name))
+                scope = scope.parent
+        self._spread_unsafe(self.root)
+
+    def _spread_unsafe(self, scope):
+        """mark the scopes around unsafe ones as unsafe too: eval and with
+           can see their variables by name. Returns whether scope is unsafe.
+        """
+        for child in scope.children:
+            if self._spread_unsafe(child):
+                scope.unsafe = True
+        return scope.unsafe
+
+    def _rename(self, scope):
+        """choose new names for the variables of the scopes in scope"""
+        for child in scope.children:
+            if not child.unsafe:
+                taken = set(declared.renamed.get(name, name)
+                            for declared, name in child.free)
+                names = sorted(child.uses.items(),
+                               key=lambda (name, uses): (-uses, name))
+                short = js_names()
+                if 'arguments' in child.uses:
+                    # a variable called arguments hides the function's
+                    # arguments, so keeps its name
+                    taken.add('arguments')
+                for name, uses in names:
+                    if name == 'arguments':
+                        continue
+                    new = next(short)
+                    while new in taken:
+                        new = next(short)
+                    child.renamed[name] = new
+            self._rename(child)
+
+    def mangle(self, js):
+        """return js with its local variables renamed"""
+        self._parse(js)
+        self._resolve()
+        self._rename(self.root)
+        out = []
+        pos = 0
+        for k in sorted(self.bindings):
+            kind, name, start, end, newline = self.tokens[k]
+            new = self.bindings[k].renamed.get(name, name)
+            if new != name:
+                out.append(js[pos:start])
+                out.append(new)
+                pos = end
+        out.append(js[pos:])
+        return ''.join(out)
+
+def jsmangle(js):
+    """return jsmin(js), with the local variables of its functions renamed
+       to short names by JavascriptMangler. Scripts it can't be sure about
+       are only minified.
+    """
+    try:
+        js = JavascriptMangler().mangle(js)
+    except CannotMangle:
+        pass
+    return jsmin(js)
+
+class MinifyCache(object):
+    """A store of minified content in the directory path, keyed by the SHA-1
+       of the minifier's name and the content, so identical files are only
+       minified once, whatever they're called and wherever they are. Entries
+       are written to a temporary file and renamed into place, so processes
+       can share the store, and evict() removes the least recently used once
+       it grows beyond max_bytes.
+    """
+    # change this when a minifier's output changes
+    version = '1'
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def _entry(self, minifier, content):
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        key = self._key(minifier)
+        key.update(content)
+        return os.path.join(self.path, key.hexdigest())
+
+    def _key(self, minifier):
+        return hashlib.sha1('%s\0%s\0' % (minifier.__name__, self.version))
+
+    def _get(self, entry):
+        """return the content stored in entry, or None if there isn't any"""
+        try:
+            f = open(entry, 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            # mark the entry as recently used
+            os.utime(entry, None)
+            return data
+        except EnvironmentError:
+            return None
+
+    def _put(self, entry, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            os.rename(tmp, entry)
+        except EnvironmentError:
+            # the store is only an optimisation
+            pass
+        return data
+
+    def minify(self, minifier, content):
+        """return minifier(content), from the store if it's there. Errors
+           raised by the minifier aren't stored, and pass on to the caller.
+        """
+        entry = self._entry(minifier, content)
+        data = self._get(entry)
+        if data is None:
+            data = self._put(entry, minifier(content))
+        return data
+
+    def minify_file(self, minifier, path, minify_iter=None):
+        """return minifier applied to the content of the file at path, like
+           minify. The file is read a block at a time, and if minify_iter, a
+           generator that does what minifier does to an iterable of chunks
+           (jsmin_iter for jsmin), is given it's minified that way too, so
+           only the minified content is held in memory.
+        """
+        key = self._key(minifier)
+        for block in read_blocks(path):
+            key.update(block)
+        entry = os.path.join(self.path, key.hexdigest())
+        data = self._get(entry)
+        if data is None:
+            if minify_iter is None:
+                data = minifier(''.join(read_blocks(path)))
+            else:
+                data = ''.join(minify_iter(read_blocks(path)))
+            data = self._put(entry, data)
+        return data
+
+    def evict(self):
+        """remove the least recently used entries until the store is no
+           bigger than max_bytes.
+        """
+        entries = []
+        total = 0
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+def benchmark(js, repeat=3):
+    """return the best of repeat times, in seconds, that JavascriptMinify and
+       FastJavascriptMinify take to minify js. Raises AssertionError if
+       their output differs.
+    """
+    import time
+    times = []
+    outputs = []
+    for engine in [JavascriptMinify, FastJavascriptMinify]:
+        best = None
+        for i in range(repeat):
+            outs = StringIO()
+            began = time.time()
+            engine().minify(StringIO(js), outs)
+            elapsed = time.time() - began
+            if best is None or elapsed < best:
+                best = elapsed
+        times.append(best)
+        outputs.append(outs.getvalue())
+    assert outputs[0] == outputs[1], 'engines disagree'
+    return times
+
 if __name__ == '__main__':
     import sys
-    jsm = JavascriptMinify()
-    jsm.minify(sys.stdin, sys.stdout)
\ No newline at end of file
+    if sys.argv[1:2] == ['--benchmark']:
+        # minify.py --benchmark file.js ... compares the two engines
+        for path in sys.argv[2:]:
+            f = open(path)
+            js = f.read()
+            f.close()
+            old, new = benchmark(js)
+            mb = len(js) / 1024.0 / 1024.0
+            print '%s: %d bytes, JavascriptMinify %.3fs (%.2f MB/s), ' \
+                  'FastJavascriptMinify %.3fs (%.2f MB/s), %.1fx faster' % (
+                  path, len(js), old, mb / old, new, mb / new, old / new)
+    elif sys.argv[1:2] == ['--cache']:
+        # minify.py --cache DIR keeps what it minifies in DIR
+        cache = MinifyCache(sys.argv[2])
+        sys.stdout.write(cache.minify(jsmin, sys.stdin.read()))
+        cache.evict()
+    else:
+        jsm = FastJavascriptMinify()
+        jsm.minify(sys.stdin, sys.stdout)
\ No newline at end of file
@@ -6,26 +6,69 @@ import sys
 import stat
 import logging
 import urllib
-import urllib2
 import tarfile
 import zipfile
 import shutil
 import uuid
+import socket
+import errno
+import threading
+import time
+import Queue
+import hashlib
+import tempfile
+import zlib
+import gzip
+import multiprocessing
+import re
+import itertools
+import select
+import struct
+import ctypes
+import ctypes.util
 from mimetypes import guess_type as guess_mime_type
 import getpass
 from optparse import OptionParser, OptionGroup
-from collections import defaultdict, namedtuple
+from collections import defaultdict, namedtuple, OrderedDict
 from urlparse import urlunparse, urlparse
 from httplib import HTTPConnection
 from httplib import HTTPSConnection
 from httplib import HTTPException
-from fnmatch import fnmatch
+from httplib import BadStatusLine
+from fnmatch import translate
+from functools import partial
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 CAN_MINIFY_JS = False
+# the minifier for each type of attachment that can be minified
+MINIFIERS = {}
+# and the ones that can minify a file a block at a time
+STREAM_MINIFIERS = {}
+# and the ones that rename variables too, for --mangle
+MANGLERS = {}
 
 try:
-    from minify import jsmin
+    from minify import jsmin, jsmin_iter, jsmangle, cssmin, htmlmin
+    from minify import MinifyCache, read_blocks
     CAN_MINIFY_JS = True
+    MINIFIERS = {'application/javascript': jsmin,
+                 'application/x-javascript': jsmin,
+                 'text/javascript': jsmin,
+                 'text/css': cssmin,
+                 'text/html': htmlmin}
+    STREAM_MINIFIERS = {'application/javascript': jsmin_iter,
+                        'application/x-javascript': jsmin_iter,
+                        'text/javascript': jsmin_iter}
+    MANGLERS = {'application/javascript': jsmangle,
+                'application/x-javascript': jsmangle,
+                'text/javascript': jsmangle}
 except:
     pass
 
@@ -131,6 +174,33 @@ class Command:
         else:
             self.logger.setLevel(logging.INFO)
 
+    def _process_url(self, url):
+        """ Extract auth credentials from url, if present """
+        parts = urlparse(url)
+        if not parts.username and not parts.password:
+            return url, None
+        if parts.port:
+            netloc = '%s:%s' % (parts.hostname, parts.port)
+        else:
+            netloc = parts.hostname
+        url_tuple = (
+                    parts.scheme,
+                    netloc,
+                    parts.path,
+                    parts.params,
+                    parts.query,
+                    parts.fragment
+                    )
+        url = urlunparse(url_tuple)
+        if parts.username and parts.password:
+            auth_tuple = (parts.username, parts.password)
+            auth = base64.encodestring('%s:%s' % auth_tuple).strip()
+            return url, "%s" % auth
+        else:
+            auth_tuple = (parts.username, getpass.getpass())
+            auth = base64.encodestring('%s:%s' % auth_tuple).strip()
+            return url, "%s" % auth
+
     def _add_options(self):
         """
         Add options to the command's option parser
@@ -179,6 +249,216 @@ class Command:
 
 
 LocatedFile = namedtuple('LocatedFile', ['path', 'filename'])
+Response = namedtuple('Response', ['status', 'reason', 'headers', 'body'])
+
+
+class ConnectionPool(object):
+    """
+    Keep persistent HTTP/1.1 connections open to each server so that all the
+    requests a command makes share a socket, rather than paying for a TCP (and
+    TLS) handshake per request. Counts how many connections were opened and
+    how many requests reused an idle one.
+    """
+    # size of the chunks a streamed request body is sent in
+    chunk_size = 64 * 1024
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.idle = defaultdict(list)
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.reused = 0
+
+    def _connect(self, key):
+        scheme, netloc = key
+        self.lock.acquire()
+        self.opened += 1
+        self.lock.release()
+        if scheme == 'https':
+            return HTTPSConnection(netloc, timeout=self.timeout)
+        return HTTPConnection(netloc, timeout=self.timeout)
+
+    def _acquire(self, key):
+        """
+        Return an idle connection to the server if there is one, otherwise
+        open a new connection. The second item of the tuple is True when the
+        connection has been reused.
+        """
+        self.lock.acquire()
+        try:
+            while self.idle[key]:
+                conn = self.idle[key].pop()
+                # an idle socket with something to read has been closed by
+                # the server
+                if conn.sock is None or \
+                        select.select([conn.sock], [], [], 0)[0]:
+                    conn.close()
+                    continue
+                self.reused += 1
+                return conn, True
+        finally:
+            self.lock.release()
+        return self._connect(key), False
+
+    def _release(self, key, conn):
+        self.lock.acquire()
+        self.idle[key].append(conn)
+        self.lock.release()
+
+    def _send(self, conn, method, path, body, headers):
+        """
+        Send a request. A callable body is taken to return an iterable of
+        strings, which are sent as they are produced, grouped into chunks of
+        about chunk_size bytes. Unless the caller has set a Content-Length
+        the body is sent with chunked transfer encoding.
+        """
+        if not callable(body):
+            conn.request(method, path, body, headers)
+            return
+        chunked = 'Content-Length' not in headers
+        conn.putrequest(method, path, skip_accept_encoding=True)
+        for header, value in headers.items():
+            conn.putheader(header, value)
+        if chunked:
+            conn.putheader("Transfer-Encoding", "chunked")
+        conn.endheaders()
+
+        def send(chunk):
+            if chunked:
+                conn.send('%x\r\n%s\r\n' % (len(chunk), chunk))
+            else:
+                conn.send(chunk)
+
+        pieces = []
+        size = 0
+        for piece in body():
+            pieces.append(piece)
+            size += len(piece)
+            if size >= self.chunk_size:
+                send(''.join(pieces))
+                pieces = []
+                size = 0
+        if pieces:
+            send(''.join(pieces))
+        if chunked:
+            conn.send('0\r\n\r\n')
+
+    def _closed(self, error, sent, method):
+        """
+        Whether error means a reused connection had been closed by the
+        server before it got the request, so the request can be sent again:
+        sending it failed, or the server hung up without answering. A POST
+        that was sent isn't repeated, as it may have been acted on, and
+        timeouts never are.
+        """
+        if isinstance(error, socket.timeout):
+            return False
+        if isinstance(error, socket.error):
+            closed = error.errno in (errno.ECONNRESET, errno.EPIPE)
+        else:
+            closed = isinstance(error, BadStatusLine)
+        return closed and (not sent or method != 'POST')
+
+    def _start(self, method, url, body, headers, auth):
+        """
+        Send a request and read the status and headers of the response,
+        returning the pool key, the connection and the response. If an idle
+        connection turns out to have been closed by the server the request
+        is retried once on a fresh connection, see _closed.
+        """
+        parts = urlparse(url)
+        if parts.port:
+            netloc = '%s:%s' % (parts.hostname, parts.port)
+        else:
+            netloc = parts.hostname
+        key = (parts.scheme, netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+
+        req_headers = {"User-Agent": "situp-%s" % __version__}
+        if auth:
+            req_headers["Authorization"] = "Basic %s" % auth
+        req_headers.update(headers)
+
+        conn, reused = self._acquire(key)
+        while True:
+            sent = False
+            try:
+                self._send(conn, method, path, body, req_headers)
+                sent = True
+                return key, conn, conn.getresponse()
+            except (HTTPException, socket.error), e:
+                conn.close()
+                if not reused or not self._closed(e, sent, method):
+                    raise
+                conn, reused = self._connect(key), False
+
+    def _finish(self, key, conn, response):
+        """
+        Hand a connection whose response has been read back to the pool,
+        unless the server is closing it.
+        """
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(key, conn)
+
+    def request(self, method, url, body=None, headers={}, auth=False):
+        """
+        Make a request to url and read the whole response, handing the
+        connection back to the pool afterwards. body can be a string or a
+        callable that returns an iterable of strings, see _send.
+        """
+        key, conn, response = self._start(method, url, body, headers, auth)
+        try:
+            data = response.read()
+        except Exception:
+            conn.close()
+            raise
+        self._finish(key, conn, response)
+        return Response(response.status, response.reason,
+                        dict(response.getheaders()), data)
+
+    def download(self, url, path, auth=False):
+        """
+        GET url into the file at path chunk_size bytes at a time, so large
+        files aren't held in memory. Raises HTTPException, and leaves no
+        file, if the response isn't a 200.
+        """
+        key, conn, response = self._start('GET', url, None, {}, auth)
+        try:
+            if response.status != 200:
+                raise HTTPException('GET %s failed: %s %s' % (
+                                    url, response.status, response.read()))
+            f = open(path, 'wb')
+            try:
+                for chunk in iter(partial(response.read, self.chunk_size),
+                                  ''):
+                    f.write(chunk)
+            except Exception:
+                f.close()
+                os.remove(path)
+                raise
+            f.close()
+        except Exception:
+            conn.close()
+            raise
+        self._finish(key, conn, response)
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        self.lock.acquire()
+        for conns in self.idle.values():
+            for conn in conns:
+                conn.close()
+        self.idle.clear()
+        self.lock.release()
+
+    def summary(self):
+        return '%s connections opened, %s reused' % (self.opened, self.reused)
 
 
 class AddServer(Command):
@@ -222,6 +502,845 @@ class AddServer(Command):
         f.close()
 
 
+class Manifest(object):
+    """
+    Records the content hash and revision of every doc last pushed to a
+    database on a server, so that unchanged docs can be skipped next time.
+    Manifests live in .situp/manifests under the application root, one file
+    per server and database.
+    """
+    def __init__(self, root, url, db):
+        key = hashlib.sha1('%s/%s' % (url.rstrip('/'), db)).hexdigest()
+        self.path = os.path.join(root, '.situp', 'manifests', '%s.json' % key)
+        self.entries = {}
+        if os.path.exists(self.path):
+            try:
+                f = open(self.path)
+                self.entries = json.load(f)
+                f.close()
+            except ValueError:
+                # a damaged manifest just means a full push
+                self.entries = {}
+
+    def unchanged(self, docid, digest, rev):
+        """
+        True if docid was last pushed with this content hash and the server
+        still has the revision that push created.
+        """
+        entry = self.entries.get(docid)
+        return bool(entry and rev and entry['hash'] == digest and
+                    entry['rev'] == rev)
+
+    def update(self, docid, digest, rev):
+        self.entries[docid] = {'hash': digest, 'rev': rev}
+
+    def save(self):
+        """
+        Write the manifest to a temporary file then rename it into place, so
+        an interrupted push never leaves a half written manifest behind.
+        """
+        path = os.path.dirname(self.path)
+        if not os.path.exists(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                # the push to another server got there first
+                pass
+        fd, tmp = tempfile.mkstemp(dir=path)
+        f = os.fdopen(fd, 'w')
+        json.dump(self.entries, f)
+        f.close()
+        os.rename(tmp, self.path)
+
+
+def compile_patterns(patterns):
+    """
+    Compile a list of shell style patterns into a single regular expression.
+    """
+    if not patterns:
+        return re.compile('(?!)')
+    return re.compile('|'.join(['(?:%s)' % translate(p) for p in patterns]))
+
+
+def gitignore_regex(pattern):
+    """
+    Translate a .gitignore style pattern (without any leading ! or trailing
+    /) into a regular expression matching paths relative to the directory
+    of the ignore file. Patterns without a slash match at any depth.
+    """
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+    i, n = 0, len(pattern)
+    regex = []
+    while i < n:
+        if pattern.startswith('**/', i):
+            regex.append('(?:.*/)?')
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            regex.append('.*')
+            i += 2
+            continue
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            regex.append('[^/]*')
+        elif c == '?':
+            regex.append('[^/]')
+        elif c == '\\' and i < n:
+            regex.append(re.escape(pattern[i]))
+            i += 1
+        elif c == '[' and ']' in pattern[i + 1:]:
+            end = pattern.index(']', i + 1)
+            chars = pattern[i:end].replace('\\', '\\\\')
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            regex.append('[%s]' % chars)
+            i = end + 1
+        else:
+            regex.append(re.escape(c))
+    if anchored:
+        return re.compile('%s$' % ''.join(regex))
+    return re.compile('(?:.*/)?%s$' % ''.join(regex))
+
+
+class IgnoreMatcher(object):
+    """
+    Decides which files and directories are left out of a push. names is a
+    compiled pattern (see compile_patterns) matched against the name of
+    every file and directory; on top of that the rules from .situpignore
+    files, which follow .gitignore semantics, are matched against paths
+    relative to root, the application root. Later rules (and rules from
+    deeper ignore files) override earlier ones.
+    """
+    filename = '.situpignore'
+
+    def __init__(self, names, root):
+        self.names = names
+        self.root = root
+        self.rules = []
+        self.loaded = set()
+
+    def load(self, directory, base):
+        """
+        Read the ignore file in directory, if there is one. base is the
+        directory relative to the application root ('' for the root).
+        """
+        path = os.path.join(directory, self.filename)
+        if path in self.loaded or not os.path.isfile(path):
+            return
+        self.loaded.add(path)
+        f = open(path)
+        for line in f:
+            line = line.rstrip('\r\n')
+            if line.endswith(' ') and not line.endswith('\\ '):
+                line = line.rstrip(' ')
+            if not line or line.startswith('#'):
+                continue
+            negate = line.startswith('!')
+            if negate or line.startswith('\\#') or line.startswith('\\!'):
+                line = line[1:]
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            if line:
+                self.rules.append((base, gitignore_regex(line), negate,
+                                   dir_only))
+        f.close()
+
+    def ignored(self, path, is_dir):
+        """
+        True if path (relative to the application root, '/' separated) is to
+        be left out.
+        """
+        if self.names.match(path.rsplit('/', 1)[-1]):
+            return True
+        ignore = False
+        for base, regex, negate, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if base:
+                if not path.startswith(base + '/'):
+                    continue
+                relative = path[len(base) + 1:]
+            else:
+                relative = path
+            if regex.match(relative):
+                ignore = not negate
+        return ignore
+
+
+class Attachment(object):
+    """
+    A file to be attached to a doc. The content is only read from disk when
+    it's needed; data holds the content when it has been transformed (e.g.
+    minified) and so differs from the file. minify is False, or the mode to
+    minify it with (see minify_file).
+    """
+    # bytes read at a time, a multiple of 3 (see iter_base64)
+    chunk_size = 3 * 64 * 1024
+
+    def __init__(self, path, content_type, data=None, minify=False):
+        self.path = path
+        self.content_type = content_type
+        self.data = data
+        self.minify = minify
+        self._digest = None
+        self._length = None
+
+    def prepare(self, minify_cache=None):
+        """
+        Do the expensive work up front: minify the content if asked to, using
+        minify_cache if given, and work out its digest and length. Returns
+        False if the content couldn't be minified, in which case the file is
+        used as is.
+        """
+        minified = True
+        if self.minify:
+            self.data = minify_file(self.path, self.content_type,
+                                    minify_cache, self.minify)
+            minified = self.data is not None
+            self.minify = False
+        self._measure()
+        return minified
+
+    def read(self):
+        """
+        Return the whole content. Only for small attachments; use iter_raw
+        or iter_base64 to stream.
+        """
+        return ''.join(self.iter_raw())
+
+    def _measure(self):
+        md5 = hashlib.md5()
+        length = 0
+        for chunk in self.iter_raw():
+            md5.update(chunk)
+            length += len(chunk)
+        self._length = length
+        self._digest = 'md5-%s' % base64.b64encode(md5.digest())
+
+    def digest(self):
+        """
+        The MD5 digest of the content, in the form CouchDB reports it.
+        """
+        if self._digest is None:
+            self._measure()
+        return self._digest
+
+    def length(self):
+        if self._length is None:
+            self._measure()
+        return self._length
+
+    def encoded_length(self):
+        """
+        Size of the base64 encoded content.
+        """
+        return (self.length() + 2) / 3 * 4
+
+    def iter_raw(self):
+        """
+        Yield the content in chunks of at most chunk_size bytes. Files are
+        read chunk by chunk, in binary mode, so memory use doesn't depend on
+        the size of the file.
+        """
+        if self.minify:
+            self.prepare()
+        if self.data is not None:
+            for i in xrange(0, len(self.data), self.chunk_size):
+                yield self.data[i:i + self.chunk_size]
+            return
+        f = open(self.path, 'rb')
+        try:
+            chunk = f.read(self.chunk_size)
+            while chunk:
+                yield chunk
+                chunk = f.read(self.chunk_size)
+        finally:
+            f.close()
+
+    def iter_base64(self):
+        """
+        Yield the base64 encoded content chunk by chunk. chunk_size is a
+        multiple of 3, so the encoded chunks join up without padding.
+        """
+        for chunk in self.iter_raw():
+            yield base64.b64encode(chunk)
+
+
+class BuildCache(object):
+    """
+    A cache of prepared attachments (their minified content, digest and
+    length) in .situp/cache under the application root. Entries are keyed by
+    the file's path, modification time and size and whether it's minified,
+    so files that haven't changed aren't read, minified or digested again.
+    Entries are written to a temporary file and renamed into place, so
+    concurrent pushes never see half written entries, and the least recently
+    used are evicted once the cache grows beyond max_bytes.
+    """
+    def __init__(self, root, max_bytes):
+        self.path = os.path.join(root, '.situp', 'cache')
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def entry(self, att):
+        """
+        The cache file for att, which must not have been prepared yet.
+        """
+        try:
+            st = os.stat(att.path)
+        except OSError:
+            return None
+        key = '%s\0%r\0%s\0%s' % (os.path.abspath(att.path), st.st_mtime,
+                                  st.st_size, att.minify)
+        return os.path.join(self.path, hashlib.sha1(key).hexdigest())
+
+    def get(self, entry, att):
+        """
+        Fill in att from the cache entry, returning whether minifying
+        succeeded (see prepare_attachment), or None if there's no entry.
+        """
+        try:
+            f = open(entry, 'rb')
+            try:
+                meta = json.loads(f.readline())
+                data = None
+                if meta['data']:
+                    data = f.read()
+            finally:
+                f.close()
+            # mark the entry as recently used
+            os.utime(entry, None)
+        except (TypeError, EnvironmentError, ValueError, KeyError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        att.data, att._digest, att._length = data, meta['digest'], \
+                                              meta['length']
+        att.minify = False
+        return meta['minified']
+
+    def put(self, entry, data, digest, length, minified):
+        if entry is None:
+            return
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # another push got there first
+                pass
+        meta = {'digest': digest, 'length': length, 'minified': minified,
+                'data': data is not None}
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.tmp')
+        f = os.fdopen(fd, 'wb')
+        f.write('%s\n' % json.dumps(meta))
+        if data is not None:
+            f.write(data)
+        f.close()
+        os.rename(tmp, entry)
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is no bigger
+        than max_bytes.
+        """
+        if not os.path.exists(self.path):
+            return
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if name.startswith('.tmp'):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+class Watcher(object):
+    """
+    Reports the files that change under a set of directories by comparing
+    their stat results every interval seconds. InotifyWatcher does the same
+    without polling where inotify is available; use watcher() to get the
+    best one.
+    """
+    # how long a burst of changes has to die down before it's reported
+    debounce = 0.1
+
+    def __init__(self, dirs, interval=0.5):
+        self.dirs = dirs
+        self.interval = interval
+        self.state = self._snapshot()
+
+    def _snapshot(self):
+        state = {}
+        for top in self.dirs:
+            for root, dirs, files in os.walk(top):
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    state[path] = (st.st_mtime, st.st_size)
+        return state
+
+    def _poll(self, timeout):
+        """
+        Wait timeout seconds and return the paths that changed meanwhile.
+        """
+        time.sleep(timeout)
+        state = self._snapshot()
+        changed = set([path for path in set(state) | set(self.state)
+                       if state.get(path) != self.state.get(path)])
+        self.state = state
+        return changed
+
+    def changes(self):
+        """
+        Block until something changes and return the paths that changed,
+        waiting for bursts of changes (e.g. saving many files) to finish.
+        """
+        changed = set()
+        while not changed:
+            changed = self._poll(self.interval)
+        more = self._poll(self.debounce)
+        while more:
+            changed.update(more)
+            more = self._poll(self.debounce)
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(Watcher):
+    """
+    A Watcher using Linux's inotify, so changes are seen as soon as they're
+    made. Raises OSError or AttributeError where inotify isn't available.
+    """
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | \
+           IN_DELETE
+    event = struct.Struct('iIII')
+
+    def __init__(self, dirs, interval=0.5):
+        self.dirs = dirs
+        self.interval = interval
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        self.watches = {}
+        for top in dirs:
+            self._add(top)
+
+    def _add(self, top):
+        """
+        Watch top and the directories below it.
+        """
+        for root, dirs, files in os.walk(top):
+            wd = self.libc.inotify_add_watch(self.fd, root, self.mask)
+            if wd >= 0:
+                self.watches[wd] = root
+
+    def _poll(self, timeout):
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.event.unpack_from(data, offset)
+            offset += self.event.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                # events were lost, so anything could have changed
+                changed.update(self.dirs)
+            elif mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+            elif wd in self.watches:
+                path = os.path.join(self.watches[wd], name)
+                if mask & self.IN_ISDIR and \
+                                mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    self._add(path)
+                changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def watcher(dirs, interval=0.5):
+    """
+    Return an InotifyWatcher for dirs if inotify is available, a polling
+    Watcher otherwise.
+    """
+    try:
+        return InotifyWatcher(dirs, interval)
+    except (OSError, AttributeError):
+        return Watcher(dirs, interval)
+
+
+def minify_file(path, content_type, minify_cache=None, mode='whitespace'):
+    """
+    Return the minified content of the file at path, using the minifier for
+    its content_type, or None if it couldn't be minified. With mode
+    'mangle' javascript variables are renamed too. Files that are the same
+    as one already in minify_cache (a MinifyCache) aren't minified again.
+    Otherwise javascript is read and minified a block at a time, so only the
+    minified content is held in memory.
+    """
+    try:
+        minifier = MINIFIERS[content_type]
+        minify_iter = STREAM_MINIFIERS.get(content_type)
+        if mode == 'mangle' and content_type in MANGLERS:
+            # renaming needs the whole script
+            minifier = MANGLERS[content_type]
+            minify_iter = None
+        if minify_cache is not None:
+            return minify_cache.minify_file(minifier, path, minify_iter)
+        if minify_iter is not None:
+            return ''.join(minify_iter(read_blocks(path)))
+        f = open(path)
+        content = f.read()
+        f.close()
+        return minifier(content)
+    except:
+        return None
+
+
+def prepare_attachment(att, minify_cache=None):
+    """
+    Prepare an Attachment, returning the results the parent process needs
+    to copy back when this runs in a worker.
+    """
+    minified = att.prepare(minify_cache)
+    return att.data, att.digest(), att.length(), minified
+
+
+def load_json(path):
+    """
+    Return the doc in the JSON file at path, or None if it can't be read.
+    """
+    try:
+        f = open(path)
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+    except:
+        return None
+
+
+def iter_json(obj, sort_keys=False):
+    """
+    Encode obj as JSON a piece at a time, streaming the content of any
+    Attachments it holds, so a doc never has to be held as one string. With
+    sort_keys the output is the same whatever order the dicts were built in.
+    """
+    if isinstance(obj, Attachment):
+        yield '{"content_type": %s, "data": "' % json.dumps(obj.content_type)
+        for chunk in obj.iter_base64():
+            yield chunk
+        yield '"}'
+    elif isinstance(obj, dict):
+        yield '{'
+        sep = ''
+        items = obj.iteritems()
+        if sort_keys:
+            items = sorted(items)
+        for key, value in items:
+            yield '%s%s: ' % (sep, json.dumps(key))
+            for chunk in iter_json(value, sort_keys):
+                yield chunk
+            sep = ', '
+        yield '}'
+    elif isinstance(obj, (list, tuple)):
+        yield '['
+        sep = ''
+        for value in obj:
+            yield sep
+            for chunk in iter_json(value, sort_keys):
+                yield chunk
+            sep = ', '
+        yield ']'
+    else:
+        yield json.dumps(obj)
+
+
+def iter_bulk_docs(docs):
+    """
+    Encode the body of a _bulk_docs request doc by doc. Docs without
+    attachments are encoded in one go.
+    """
+    yield '{"docs": ['
+    sep = ''
+    for doc in docs:
+        yield sep
+        if doc.get('_attachments'):
+            for chunk in iter_json(doc):
+                yield chunk
+        else:
+            yield json.dumps(doc)
+        sep = ', '
+    yield ']}'
+
+
+def doc_hash(doc):
+    """
+    Hash the content of a doc, ignoring its _rev. Attachments are hashed by
+    their type and digest rather than their content.
+    """
+    def signature(obj):
+        if isinstance(obj, Attachment):
+            return [obj.content_type, obj.digest()]
+        raise TypeError('%r is not JSON serializable' % obj)
+    content = dict(doc)
+    content.pop('_rev', None)
+    return hashlib.sha1(json.dumps(content, sort_keys=True,
+                                   default=signature)).hexdigest()
+
+
+# content types that are already compressed, so not worth gzipping again
+INCOMPRESSIBLE_TYPES = ['image/png', 'image/jpeg', 'image/gif', 'image/webp',
+                        'audio/', 'video/', 'application/zip',
+                        'application/gzip', 'application/x-gzip',
+                        'application/x-bzip2', 'application/x-7z-compressed',
+                        'application/font-woff', 'font/woff']
+
+
+def compressible(content_type):
+    for prefix in INCOMPRESSIBLE_TYPES:
+        if content_type.startswith(prefix):
+            return False
+    return True
+
+
+def gzip_body(body):
+    """
+    Wrap a request body (a string or a callable, see ConnectionPool._send)
+    so that it is gzip compressed as it streams.
+    """
+    def iter_gzip():
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        if callable(body):
+            pieces = body()
+        else:
+            pieces = [body]
+        for piece in pieces:
+            data = compressor.compress(piece)
+            if data:
+                yield data
+        yield compressor.flush()
+    return iter_gzip
+
+
+def multipart_doc(doc):
+    """
+    Encode doc as a multipart/related body for a PUT, with the doc's JSON in
+    the first part and the raw content of each Attachment in a part of its
+    own, so attachments go over the wire without base64 inflation. Returns
+    the boundary, the length of the body and a callable that yields it.
+    """
+    boundary = uuid.uuid4().hex
+    content = dict(doc)
+    attachments = content.pop('_attachments', {})
+    follows = []
+    # the parts that follow must come in the order the attachments are
+    # listed in
+    meta = OrderedDict()
+    for name in sorted(attachments.keys()):
+        att = attachments[name]
+        if isinstance(att, Attachment):
+            follows.append(att)
+            att = {'follows': True, 'content_type': att.content_type,
+                   'length': att.length()}
+        meta[name] = att
+    content['_attachments'] = meta
+    body = json.dumps(content)
+
+    head = '--%s\r\nContent-Type: application/json\r\n\r\n%s\r\n' % (
+                                                              boundary, body)
+    part = '--%s\r\n\r\n' % boundary
+    tail = '--%s--' % boundary
+    length = len(head) + len(tail)
+    for att in follows:
+        length += len(part) + att.length() + 2
+
+    def iter_body():
+        yield head
+        for att in follows:
+            yield part
+            for chunk in att.iter_raw():
+                yield chunk
+            yield '\r\n'
+        yield tail
+    return boundary, length, iter_body
+
+
+def doc_size(doc):
+    """
+    Estimate how many bytes doc adds to a _bulk_docs body.
+    """
+    attachments = doc.get('_attachments')
+    if not attachments:
+        return len(json.dumps(doc))
+    content = dict(doc)
+    del content['_attachments']
+    size = len(json.dumps(content))
+    for name, att in attachments.items():
+        if isinstance(att, Attachment):
+            size += len(name) + att.encoded_length() + 64
+        else:
+            size += len(name) + len(json.dumps(att))
+    return size
+
+
+def batches(docs, max_bytes, max_docs):
+    """
+    Split docs into lists of at most max_docs docs, and at most max_bytes
+    bytes unless a single doc is bigger than that.
+    """
+    batch = []
+    size = 0
+    for doc in docs:
+        this_size = doc_size(doc)
+        if batch and (size + this_size > max_bytes or len(batch) >= max_docs):
+            yield batch
+            batch = []
+            size = 0
+        batch.append(doc)
+        size += this_size
+    if batch:
+        yield batch
+
+
+class BatchError(HTTPException):
+    """
+    A _bulk_docs request the server refused, carrying the response status so
+    the batch can be split or retried.
+    """
+    def __init__(self, status, body):
+        HTTPException.__init__(self, '_bulk_docs failed: %s %s' % (status,
+                                                                   body))
+        self.status = status
+
+
+class Throttle(object):
+    """
+    An adaptive limit on how many batches are uploaded to a server at once.
+    The limit grows by one after each batch that completes in reasonable
+    time, shrinks by one when a batch takes more than twice the average and
+    halves when the server fails a request (e.g. with a 413 or a 5xx).
+    """
+    def __init__(self, maximum):
+        self.maximum = max(1, maximum)
+        self.limit = 1
+        self.active = 0
+        self.latency = None
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        self.cond.acquire()
+        while self.active >= self.limit:
+            self.cond.wait()
+        self.active += 1
+        self.cond.release()
+
+    def release(self, elapsed=None, failed=False):
+        """
+        Give back a slot, adjusting the limit according to how long the
+        request took or whether it failed. If neither is given the limit is
+        left alone.
+        """
+        self.cond.acquire()
+        self.active -= 1
+        if failed:
+            self.limit = max(1, self.limit / 2)
+        elif elapsed is not None:
+            if self.latency is not None and elapsed > 2 * self.latency:
+                self.limit = max(1, self.limit - 1)
+            elif self.limit < self.maximum:
+                self.limit += 1
+            if self.latency is None:
+                self.latency = elapsed
+            else:
+                self.latency = 0.8 * self.latency + 0.2 * elapsed
+        self.cond.notifyAll()
+        self.cond.release()
+
+
+class ServerResult(object):
+    """
+    The outcome of pushing a set of docs to one server. Batches are pushed
+    from several threads, so counts are updated via add.
+    """
+    def __init__(self, server):
+        self.server = server
+        self.error = None
+        self.elapsed = 0.0
+        self.docs = 0
+        self.skipped = 0
+        self.bytes_saved = 0
+        self.failed = []
+        self.lock = threading.Lock()
+
+    def add(self, **counts):
+        self.lock.acquire()
+        for name, count in counts.items():
+            setattr(self, name, getattr(self, name) + count)
+        self.lock.release()
+
+    def fail(self, docid, error, reason):
+        """
+        Record a doc the server wouldn't accept.
+        """
+        self.lock.acquire()
+        self.failed.append((docid, error, reason))
+        self.lock.release()
+
+    def rate(self):
+        if not self.elapsed:
+            return 0.0
+        return self.docs / self.elapsed
+
+    def __str__(self):
+        if self.error:
+            return "upload to %s failed after %.2fs: %s" % (self.server,
+                                                      self.elapsed, self.error)
+        msg = "upload to %s pushed %s docs (%s unchanged) in %.2fs" % (
+                        self.server, self.docs, self.skipped, self.elapsed)
+        msg += " (%.1f docs/s)" % self.rate()
+        if self.failed:
+            msg += ", %s docs failed" % len(self.failed)
+        if self.bytes_saved:
+            msg += ", %s bytes saved by attachment stubs" % self.bytes_saved
+        return msg
+
+
 class Push(Command):
     """
     The Push command sends the application to the CouchDB server. Specify a
@@ -232,7 +1351,31 @@ class Push(Command):
     no_required_args = 0
     # TODO: pick this up from config
     # TODO: add a --no-push-docs option
-    ignored_files = ['.DS_Store', '.cvs', '.svn', '.hg', '.git', '*.swp']
+    ignored_files = ['.DS_Store', '.cvs', '.svn', '.hg', '.git', '*.swp',
+                     IgnoreMatcher.filename]
+    _ignored_names = None
+    # how many doc ids to look up in a single _all_docs request
+    rev_batch_size = 1000
+    # how many times to resend a batch that failed with a server error
+    batch_retries = 3
+    # how many times to retry docs that failed, and the delay before the
+    # first retry of a doc or batch (doubled for each one after)
+    conflict_retries = 4
+    retry_delay = 0.5
+    # doc errors that retrying won't fix
+    permanent_errors = ['forbidden', 'unauthorized', 'bad_request']
+    # how many _docs files to read and prepare at a time
+    load_batch_size = 1000
+    # how many windows of docs (batch_docs * batch_concurrency) a slow server
+    # can fall behind the fastest before loading waits for it
+    stream_lag = 4
+    # _docs files holding a doc per line
+    ndjson_extensions = ('.ndjson', '.jsonl', '.ndjson.gz', '.jsonl.gz')
+
+    def __init__(self):
+        Command.__init__(self)
+        # bytes saved by minifying, by content type
+        self.minify_saved = defaultdict(int)
 
     def _add_options(self):
         """
@@ -249,78 +1392,574 @@ class Push(Command):
                 help="Push the app to servers (multiple -s options allowed)")
         group.add_option('-e', '--database', dest='database',
                 help="Push the app to named database")
+        group.add_option("--full",
+                dest="full", default=False, action="store_true",
+                help="Ignore the push manifest and upload every document")
+        group.add_option("--server-concurrency",
+                dest="server_concurrency", default=4, type="int",
+                help="Push to at most this many servers at once, default 4")
+        group.add_option("--batch-bytes",
+                dest="batch_bytes", default=8 * 1024 * 1024, type="int",
+                help="Split uploads into _bulk_docs requests of at most this "
+                     "many bytes, default 8MB")
+        group.add_option("--batch-docs",
+                dest="batch_docs", default=1000, type="int",
+                help="Send at most this many docs per _bulk_docs request, "
+                     "default 1000")
+        group.add_option("--batch-concurrency",
+                dest="batch_concurrency", default=4, type="int",
+                help="Upload at most this many batches to a server at once, "
+                     "default 4; fewer are used if the server struggles")
+        group.add_option("--attachments",
+                dest="attachments", default="auto",
+                choices=['auto', 'inline', 'multipart'],
+                help="How to upload attachments: inline as base64 in "
+                     "_bulk_docs, multipart (a multipart/related PUT per doc, "
+                     "sending the raw bytes) or auto, which uses multipart "
+                     "for docs with large attachments [default: auto]")
+        group.add_option("--multipart-threshold",
+                dest="multipart_threshold", default=1024 * 1024, type="int",
+                help="In auto mode, PUT docs with at least this many bytes of "
+                     "attachments as multipart, default 1MB")
+        group.add_option("-z", "--gzip",
+                dest="gzip", default=False, action="store_true",
+                help="gzip request bodies; attachments that are already "
+                     "compressed (images, archives...) are sent as they are")
+        group.add_option("--timeout",
+                dest="timeout", default=120, type="float",
+                help="Give up on a server that doesn't respond within this "
+                     "many seconds, default 120")
+        group.add_option("--from-artifact",
+                dest="from_artifact", default=None, metavar="FILE",
+                help="Push the docs in an artifact written by the build "
+                     "command instead of building the app")
+        group.add_option("--watch",
+                dest="watch", default=False, action="store_true",
+                help="Keep running after the push, pushing the design docs "
+                     "and docs that change")
+        group.add_option("--watch-interval",
+                dest="watch_interval", default=0.5, type="float",
+                help="When watching without inotify, look for changes this "
+                     "often, in seconds, default 0.5")
+        self._add_build_options(group)
+        self.parser.add_option_group(group)
+
+    def _add_build_options(self, group):
+        """
+        Add the options that control how the app is built, shared with the
+        build command
+        """
+        group.add_option("--cache-size",
+                dest="cache_size", default=256, type="int",
+                help="Keep up to this many MB of prepared attachments in "
+                     ".situp/cache and minified files in .situp/minify "
+                     "between them, 0 disables the caches, default 256")
+        group.add_option("-j", "--jobs",
+                dest="jobs", default=1, type="int",
+                help="Minify and digest attachments in this many processes, "
+                     "default 1")
 
         if CAN_MINIFY_JS:
             group.add_option("-m", "--minify",
-                dest="minify", default=False, action="store_true",
-                help="Minify javascript before pushing to database")
-
-        self.parser.add_option_group(group)
+                dest="minify", default=False, action="store_const",
+                const="whitespace",
+                help="Minify javascript, CSS and HTML before pushing to "
+                     "database")
+            group.add_option("--mangle",
+                dest="minify", action="store_const", const="mangle",
+                help="Minify, and rename the local variables of javascript "
+                     "functions to short names too")
 
     def _push_docs(self, docs_list, db, servers):
         """
-        Push dictionaries into json docs in the server
-        TODO: spin off into a worker thread
+        Push dictionaries into json docs on each server. Servers are uploaded
+        to in parallel, at most options.server_concurrency at a time, so a
+        slow or dead server doesn't hold up the rest. docs_list can also be
+        an iterator, which is read once, as the servers need the docs, and
+        streamed to every server at the same time. Returns a dict of server
+        name to ServerResult.
         """
+        if not isinstance(docs_list, list):
+            return self._stream_docs(docs_list, db, servers)
+        results = {}
+        queue = Queue.Queue()
         for server in servers.keys():
-            srv = servers[server]
-            self.logger.info('upload to %s (%s/%s)' % (server, srv['url'], db))
-            data = {}
-            try:
-                def request(server, method, url, auth=False):
-                    conn = None
-                    if server.startswith('https://'):
-                        conn = HTTPSConnection(server.strip('https://'))
-                    else:
-                        conn = HTTPConnection(server.strip('http://'))
-                    conn.putrequest(method, url)
-                    if auth:
-                        conn.putheader("Authorization", "Basic %s" % auth)
-                    conn.putheader("User-Agent", "situp-%s" % __version__)
-                    conn.endheaders()
-                    response = conn.getresponse()
-                    conn.close()
-                    return response
-
-                request(srv['url'], 'PUT', "/%s" % db, srv.get('auth', False))
-
-                for doc in docs_list:
-                    if '_id' in doc.keys():
-                        docid = doc['_id']
-                        # HEAD the doc
-                        url = "/%s/%s" % (db, docid)
-                        auth = srv.get('auth', False)
-                        head = request(srv['url'], 'HEAD', url, auth)
-                        # get its _rev, append _rev to the doc dict
-                        if head.getheader('etag', False):
-                            etag = head.getheader('etag', False)
-                            doc['_rev'] = etag.replace('"', '')
-
-                req = urllib2.Request('%s/%s/_bulk_docs' % (srv['url'], db))
-                req.add_header("Content-Type", "application/json")
-                req.add_header("User-Agent", "situp-%s" % __version__)
-                if 'auth' in srv.keys():
-                    req.add_header("Authorization", "Basic %s" % srv['auth'])
-                data = {'docs': docs_list}
-                req.add_data(json.dumps(data))
-                f = urllib2.urlopen(req)
-                self.logger.info(f.read())
-            except Exception, e:
-                self.logger.error("upload to %s failed" % server)
-                self.logger.info(e)
+            queue.put(server)
+
+        def worker():
+            while True:
+                try:
+                    server = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                results[server] = self._push_to_server(docs_list, db, server,
+                                                       servers[server])
+
+        concurrency = max(1, self.options.server_concurrency)
+        threads = []
+        for i in range(min(concurrency, len(servers))):
+            t = threading.Thread(target=worker)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        return results
+
+    def _stream_docs(self, docs, db, servers):
+        """
+        Push the docs docs yields to every server at once. Each server reads
+        from its own queue, and docs are only loaded while the fastest server
+        has less than a window of batches queued, so a slow server falls
+        behind on its own rather than holding up the others. To keep memory
+        bounded loading also waits while any server is stream_lag windows
+        behind. A server that gives up is dropped, and its queue with it.
+        """
+        results = {}
+        queues = {}
+        window = self.options.batch_docs * self.options.batch_concurrency
+        lag = window * self.stream_lag
+        # notified whenever a doc is taken from a queue or a server gives up
+        room = threading.Condition()
+
+        def take(queue):
+            while True:
+                doc = queue.get()
+                room.acquire()
+                room.notify()
+                room.release()
+                if doc is None:
+                    return
+                yield doc
+
+        def worker(server, queue):
+            results[server] = self._push_to_server(take(queue), db, server,
+                                                   servers[server])
+            room.acquire()
+            del queues[server]
+            room.notify()
+            room.release()
+
+        threads = []
+        for server in servers.keys():
+            queues[server] = Queue.Queue()
+            t = threading.Thread(target=worker,
+                                 args=(server, queues[server]))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        try:
+            for doc in docs:
+                room.acquire()
+                try:
+                    sizes = [q.qsize() for q in queues.values()]
+                    while sizes and (min(sizes) >= window or
+                                     max(sizes) >= lag):
+                        room.wait()
+                        sizes = [q.qsize() for q in queues.values()]
+                    live = queues.values()
+                finally:
+                    room.release()
+                if not live:
+                    break
+                for queue in live:
+                    queue.put(doc)
+        finally:
+            room.acquire()
+            live = queues.values()
+            room.release()
+            for queue in live:
+                queue.put(None)
+            for t in threads:
+                t.join()
+        return results
+
+    def _push_to_server(self, docs_list, db, server, srv):
+        """
+        Upload docs_list to a single server, recording how it went in a
+        ServerResult rather than raising. The docs are split into batches of
+        at most options.batch_bytes and options.batch_docs, which are sent
+        concurrently under a Throttle. Batches the server rejects as too large
+        are split in half, those that hit a server error are retried.
+        """
+        result = ServerResult(server)
+        self.logger.info('upload to %s (%s/%s)' % (server, srv['url'], db))
+        start = time.time()
+        try:
+            self.pool.request('PUT', '%s/%s' % (srv['url'], db), '',
+                              auth=srv.get('auth', False))
+            manifest = Manifest(self.options.root, srv['url'], db)
+            # batches to send again go in queue, and are sent before any
+            # more are taken from source
+            queue = Queue.Queue()
+            source = batches(docs_list, self.options.batch_bytes,
+                             self.options.batch_docs)
+            source_lock = threading.Lock()
+            throttle = Throttle(self.options.batch_concurrency)
+            # set when the server can't be reached, to stop sending batches
+            stopped = threading.Event()
+
+            def next_batch():
+                if stopped.is_set():
+                    return None
+                try:
+                    return queue.get_nowait()
+                except Queue.Empty:
+                    pass
+                source_lock.acquire()
+                try:
+                    return source.next(), 0
+                except StopIteration:
+                    return None
+                finally:
+                    source_lock.release()
+
+            def worker():
+                while True:
+                    throttle.acquire()
+                    item = next_batch()
+                    if item is None:
+                        throttle.release()
+                        return
+                    batch, attempt = item
+                    began = time.time()
+                    try:
+                        self._push_batch(batch, db, srv, manifest, result)
+                        throttle.release(time.time() - began)
+                    except BatchError, e:
+                        throttle.release(failed=True)
+                        if e.status == 413 and len(batch) > 1:
+                            half = len(batch) / 2
+                            queue.put((batch[:half], attempt))
+                            queue.put((batch[half:], attempt))
+                        elif e.status >= 500 and \
+                                attempt < self.batch_retries:
+                            time.sleep(self.retry_delay * 2 ** attempt)
+                            queue.put((batch, attempt + 1))
+                        else:
+                            result.error = e
+                    except (socket.error, HTTPException), e:
+                        # stop before freeing the slot for another batch
+                        stopped.set()
+                        result.error = e
+                        throttle.release(failed=True)
+                    except Exception, e:
+                        throttle.release(failed=True)
+                        result.error = e
+
+            threads = []
+            for i in range(throttle.maximum):
+                t = threading.Thread(target=worker)
+                t.daemon = True
+                t.start()
+                threads.append(t)
+            for t in threads:
+                t.join()
+            manifest.save()
+        except Exception, e:
+            result.error = e
+        result.elapsed = time.time() - start
+        return result
+
+    def _push_batch(self, docs_list, db, srv, manifest, result):
+        """
+        Push a batch of docs, then retry just the docs that failed (e.g. with
+        a conflict because someone else updated them in the meantime) with
+        exponential backoff. Docs that still fail are recorded in result.
+        """
+        attempt = 0
+        while True:
+            failures = self._send_batch(docs_list, db, srv, manifest, result)
+            retry = []
+            for doc, row in failures:
+                if row['error'] in self.permanent_errors or \
+                        attempt >= self.conflict_retries:
+                    result.fail(row.get('id', doc.get('_id')), row['error'],
+                                row.get('reason', ''))
+                else:
+                    retry.append(doc)
+            if not retry:
+                return
+            self.logger.debug('retrying %s docs' % len(retry))
+            time.sleep(self.retry_delay * 2 ** attempt)
+            attempt += 1
+            docs_list = retry
+
+    def _send_batch(self, docs_list, db, srv, manifest, result):
+        """
+        Look up the revisions of a batch of docs, drop those that haven't
+        changed since the last push and send the rest, to _bulk_docs or as
+        multipart. Returns a list of (doc, row) for the docs the server
+        refused, where row is the doc's entry in the response.
+        """
+        auth = srv.get('auth', False)
+        # docs with attachments are looked up with their bodies, to find the
+        # attachments the server already has
+        plain, attached = [], []
+        for doc in docs_list:
+            if '_id' in doc:
+                if doc.get('_attachments'):
+                    attached.append(doc['_id'])
+                else:
+                    plain.append(doc['_id'])
+        digests = {}
+        revs = self._fetch_revs(srv, db, plain)
+        revs.update(self._fetch_revs(srv, db, attached, digests))
+        hashes = {}
+        to_push = []
+        skipped = 0
+        saved = 0
+        for original in docs_list:
+            # copy the doc so revs from one server don't leak into the upload
+            # to the next
+            doc = dict(original)
+            doc.pop('_rev', None)
+            docid = doc.get('_id')
+            if docid is not None:
+                digest = doc_hash(doc)
+                if not self.options.full and \
+                        manifest.unchanged(docid, digest, revs.get(docid)):
+                    skipped += 1
+                    continue
+                hashes[docid] = digest
+            if docid in revs:
+                doc['_rev'] = revs[docid]
+                if docid in digests:
+                    saved += self._stub_attachments(doc, digests[docid])
+            to_push.append((original, doc))
+
+        sent = []
+        bulk = []
+        for original, doc in to_push:
+            if self._use_multipart(doc):
+                sent.append((original, self._put_multipart(doc, db, srv)))
+            else:
+                bulk.append((original, doc))
+        if bulk:
+            headers = {"Content-Type": "application/json"}
+            body = lambda: iter_bulk_docs([doc for original, doc in bulk])
+            if self.options.gzip:
+                headers["Content-Encoding"] = "gzip"
+                body = gzip_body(body)
+            response = self.pool.request('POST',
+                                '%s/%s/_bulk_docs' % (srv['url'], db),
+                                body, headers, auth)
+            if response.status not in (200, 201):
+                raise BatchError(response.status, response.body)
+            self.logger.debug(response.body)
+            rows = json.loads(response.body)
+            sent.extend(zip([original for original, doc in bulk], rows))
+
+        failures = []
+        for original, row in sent:
+            if 'error' in row:
+                failures.append((original, row))
+            elif row.get('id') in hashes:
+                manifest.update(row['id'], hashes[row['id']], row['rev'])
+        result.add(docs=len(sent) - len(failures), skipped=skipped,
+                   bytes_saved=saved)
+        return failures
+
+    def _use_multipart(self, doc):
+        """
+        Decide whether doc should be PUT as multipart/related rather than go
+        in a _bulk_docs request. In auto mode docs whose attachments (other
+        than stubs) add up to options.multipart_threshold bytes or more are,
+        as are docs with already compressed attachments when gzipping, so
+        that those attachments aren't compressed again.
+        """
+        mode = self.options.attachments
+        if mode == 'inline' or '_id' not in doc:
+            return False
+        size = 0
+        compressed = False
+        for att in doc.get('_attachments', {}).values():
+            if isinstance(att, Attachment):
+                size += att.length()
+                compressed = compressed or not compressible(att.content_type)
+        if not size:
+            return False
+        return mode == 'multipart' or size >= self.options.multipart_threshold \
+                or (self.options.gzip and compressed)
+
+    def _put_multipart(self, doc, db, srv):
+        """
+        PUT doc and its attachments as multipart/related, returning a row
+        like those in a _bulk_docs response. The body isn't compressed, even
+        with --gzip, as CouchDB only gunzips JSON request bodies.
+        """
+        docid = doc['_id']
+        if docid.startswith('_design/'):
+            path = '_design/%s' % urllib.quote(docid[8:], safe='')
+        else:
+            path = urllib.quote(docid, safe='')
+        boundary, length, body = multipart_doc(doc)
+        # never gzipped: CouchDB reads multipart bodies as they come
+        headers = {
+            "Content-Type": 'multipart/related; boundary="%s"' % boundary,
+            "Content-Length": str(length),
+        }
+        response = self.pool.request('PUT', '%s/%s/%s' % (srv['url'], db,
+                                                            path),
+                                     body, headers, srv.get('auth', False))
+        if response.status >= 500 or response.status == 413:
+            raise BatchError(response.status, response.body)
+        self.logger.debug(response.body)
+        row = json.loads(response.body)
+        row['id'] = docid
+        return row
+
+    def _report(self, results):
+        """
+        Log the outcome of a push to each server, returning True if every
+        server took all the docs.
+        """
+        ok = True
+        for server in sorted(results.keys()):
+            result = results[server]
+            if result.error or result.failed:
+                self.logger.error(str(result))
+                ok = False
+            else:
+                self.logger.info(str(result))
+            for docid, error, reason in result.failed:
+                self.logger.error('  %s: %s %s' % (docid, error, reason))
+        return ok
+
+    def _stub_attachments(self, doc, digests):
+        """
+        Replace the attachments of doc that the server already holds with
+        stubs, given a dict of the server's attachment names to digests.
+        Returns the number of (base64 encoded) bytes that won't be sent.
+        """
+        saved = 0
+        attachments = dict(doc['_attachments'])
+        for name, att in attachments.items():
+            if isinstance(att, Attachment) and \
+                    digests.get(name) == att.digest():
+                attachments[name] = {'stub': True}
+                saved += att.encoded_length()
+        doc['_attachments'] = attachments
+        return saved
+
+    def _fetch_revs(self, srv, db, ids, digests=None):
+        """
+        Look up the current revision of each id in ids, posting the keys to
+        _all_docs in batches of rev_batch_size. Returns a dict of id to _rev
+        for the docs that exist; missing and deleted docs are left out so
+        they are created afresh. If digests is a dict the doc bodies are
+        fetched too, and digests is filled with a dict of attachment name to
+        digest for each doc.
+        """
+        revs = {}
+        url = '%s/%s/_all_docs' % (srv['url'], db)
+        if digests is not None:
+            url += '?include_docs=true'
+        headers = {"Content-Type": "application/json"}
+        for i in range(0, len(ids), self.rev_batch_size):
+            keys = ids[i:i + self.rev_batch_size]
+            response = self.pool.request('POST', url,
+                                         json.dumps({'keys': keys}), headers,
+                                         srv.get('auth', False))
+            if response.status != 200:
+                raise HTTPException('revision lookup failed: %s %s' % (
+                                            response.status, response.body))
+            for row in json.loads(response.body)['rows']:
+                value = row.get('value')
+                if 'error' in row or value.get('deleted'):
+                    continue
+                revs[row['id']] = value['rev']
+                if digests is not None and row.get('doc'):
+                    atts = row['doc'].get('_attachments', {})
+                    digests[row['id']] = dict((name, att.get('digest'))
+                                              for name, att in atts.items())
+        return revs
 
     def _allowed_file(self, filepath):
         """
         Check that filepath isn't in self.ignored_files, return True if the
         file is allowed.
         """
-        return True not in [fnmatch(filepath, r) for r in self.ignored_files]
+        if self._ignored_names is None:
+            self._ignored_names = compile_patterns(self.ignored_files)
+        return not self._ignored_names.match(filepath)
+
+    def _matcher(self, root):
+        """
+        The IgnoreMatcher for the application in root.
+        """
+        matcher = getattr(self, 'matcher', None)
+        if matcher is None or matcher.root != root:
+            matcher = self.matcher = IgnoreMatcher(
+                            compile_patterns(self.ignored_files), root)
+        return matcher
+
+    def _walk(self, top, root):
+        """
+        Walk the tree under top, like os.walk, leaving out (and not
+        descending into) the files and directories that self.ignored_files
+        or .situpignore files in the application in root exclude. Time spent
+        walking is added to self.walk_time.
+        """
+        began = time.time()
+        matcher = self._matcher(root)
+        top_rel = os.path.relpath(top, root).replace(os.sep, '/')
+        if top_rel == os.curdir or top_rel.startswith(os.pardir):
+            # match paths relative to top if it isn't in the application
+            top_rel = ''
+            root = top
+        # ignore files in the directories above top apply too
+        parts = top_rel.split('/') if top_rel else []
+        for i in range(len(parts)):
+            matcher.load(os.path.join(root, *parts[:i]), '/'.join(parts[:i]))
+
+        stack = [(top, top_rel)]
+        while stack:
+            path, rel = stack.pop()
+            matcher.load(path, rel)
+            dirs, files, links = [], [], set()
+            for name, is_dir, is_link in self._scan(path):
+                child = '%s/%s' % (rel, name) if rel else name
+                if matcher.ignored(child, is_dir):
+                    continue
+                if is_dir:
+                    dirs.append(name)
+                    if is_link:
+                        links.add(name)
+                else:
+                    files.append(name)
+            dirs.sort()
+            files.sort()
+            self.walk_time = getattr(self, 'walk_time', 0) + \
+                                                time.time() - began
+            yield path, dirs, files
+            began = time.time()
+            for name in reversed(dirs):
+                # like os.walk, don't follow symlinked directories
+                if name not in links:
+                    child = '%s/%s' % (rel, name) if rel else name
+                    stack.append((os.path.join(path, name), child))
+        self.walk_time = getattr(self, 'walk_time', 0) + time.time() - began
+
+    def _scan(self, path):
+        """
+        List the entries of a directory as (name, is_dir, is_link), using
+        scandir where it's available to avoid a stat per entry.
+        """
+        if scandir is not None:
+            return [(entry.name, entry.is_dir(), entry.is_symlink())
+                    for entry in scandir(path)]
+        entries = []
+        for name in os.listdir(path):
+            full = os.path.join(path, name)
+            entries.append((name, os.path.isdir(full), os.path.islink(full)))
+        return entries
 
     def _attach(self, afile, file_path, minify=False):
         """
         Takes a path to a file, and the name of the attachment, works out it's
         mime type (assumes text/plain if it can't be determined) and returns
-        the necessary dict to upload to a doc.
+        a dict of the attachment name to an Attachment.
         """
         mime = guess_mime_type(file_path)[0]
 
@@ -329,115 +1968,407 @@ class Push(Command):
             self.logger.warning(msg % file_path)
             mime = 'text/plain'
 
-        if minify and mime == "application/javascript":
-            data = self._minify(file_path)
-        else:
-            f = open(os.path.join(file_path))
-            data = base64.encodestring(f.read())
-            f.close()
+        if mime not in MINIFIERS:
+            minify = False
+        return {afile: Attachment(file_path, mime, minify=minify)}
 
-        return {afile: {
-                'data': data,
-                'content_type': mime
-                }}
+    def _prepare(self, docs):
+        """
+        Prepare (minify and digest) the attachments of docs, spreading the
+        work over options.jobs processes. Attachments are handed out
+        individually, so the work balances however it's split between design
+        docs, and the results are the same as preparing them one by one.
+        Minified content is also kept by content in .situp/minify, so copies
+        of the same file (a library vendored into several designs, say) are
+        only minified once.
+        """
+        cache = None
+        minify_cache = None
+        if self.options.cache_size > 0:
+            size = self.options.cache_size * 1024 * 1024
+            if CAN_MINIFY_JS:
+                # the two stores share the --cache-size budget
+                size /= 2
+                minify_cache = MinifyCache(
+                                os.path.join(self.options.root, '.situp',
+                                             'minify'), size)
+            cache = BuildCache(self.options.root, size)
+        attachments = []
+        entries = []
+        minifying = []
+        for doc in docs:
+            for att in doc.get('_attachments', {}).values():
+                if isinstance(att, Attachment):
+                    if att.minify:
+                        minifying.append(att)
+                    if cache:
+                        entry = cache.entry(att)
+                        minified = cache.get(entry, att)
+                        if minified is not None:
+                            if not minified:
+                                msg = "Could not minify %s, uploading " \
+                                      "expanded version"
+                                self.logger.debug(msg % att.path)
+                            continue
+                        entries.append(entry)
+                    attachments.append(att)
+        prepare = partial(prepare_attachment, minify_cache=minify_cache)
+        workers = self._workers()
+        if workers and len(attachments) > 1:
+            chunksize = max(1, len(attachments) / (self.options.jobs * 4))
+            results = workers.map(prepare, attachments, chunksize)
+        else:
+            results = map(prepare, attachments)
+        for att, (data, digest, length, minified) in zip(attachments,
+                                                         results):
+            att.data, att._digest, att._length = data, digest, length
+            att.minify = False
+            if not minified:
+                msg = "Could not minify %s, uploading expanded version"
+                self.logger.debug(msg % att.path)
+        if cache:
+            for entry, (data, digest, length, minified) in zip(entries,
+                                                               results):
+                cache.put(entry, data, digest, length, minified)
+            cache.evict()
+            self.logger.debug('build cache: %s hits, %s misses' % (
+                                                  cache.hits, cache.misses))
+        if minify_cache and minifying:
+            minify_cache.evict()
+        for att in minifying:
+            if att.data is not None:
+                saved = os.path.getsize(att.path) - att.length()
+                self.minify_saved[att.content_type] += saved
 
     def _walk_design(self, name, design, options):
         """
         Walk through the design document, building a dictionary as it goes.
+        Each file is inserted straight into the dictionary at its path, so
+        the build is linear in the number of files.
         """
 
-        def nest(path_dict, path_elem):
+        def insert(tree, path, key, value):
             """
-            Build the required nested data structure
+            Put value at key in the nested dict found by following path from
+            tree, creating the dicts along the way.
             """
-            if self._allowed_file(path_elem):
-                return {path_elem: path_dict}
-
-        def recurse_update(a_dict, b_dict):
-            for k, v in b_dict.items():
-                if k not in a_dict.keys() or type(v) != type(a_dict[k]):
-                    a_dict[k] = v
-                else:
-                    a_dict[k] = recurse_update(a_dict[k], v)
-            return a_dict
+            node = tree
+            for path_elem in path:
+                child = node.get(path_elem)
+                if not isinstance(child, dict):
+                    child = node[path_elem] = {}
+                node = child
+            node[key] = value
 
         attachments = {}
         app = {'_id': name}
-        for root, dirs, files in os.walk(design):
-            path = root.split(name)[1].split('/')[1:]
-            dirs = filter(self._allowed_file, dirs)
-            if files:
-                d = {}
-                for afile in filter(self._allowed_file, files):
-                    afile_path = os.path.join(root, afile)
-                    if '_attachments' in path:
-                        min = options.minify
-
-                        tmp_root = os.path.join(root, afile)
-
-                        tmp_path = list(path)
-                        tmp_path.remove('_attachments')
-                        tmp_path.append(afile)
-                        tmp_path = os.path.join(*tmp_path)
-
-                        attach = self._attach(tmp_path, tmp_root, min)
-                        attachments.update(attach)
-                    else:
-                        if len(path) > 0 and path[0] in ['views', 'lists',
-                                'shows', 'filters']:
-                            f = open(afile_path)
-                            d[afile.strip('.js')] = f.read()
-                            f.close()
-                        else:
-                            f = open(afile_path)
-                            d[afile] = f.read()
-                            f.close()
-                if d.keys():
-                    app = recurse_update(app, reduce(nest, reversed(path), d))
+        for root, dirs, files in self._walk(design, options.root):
+            path = os.path.relpath(root, design).split(os.sep)
+            if path == [os.curdir]:
+                path = []
+            for afile in files:
+                afile_path = os.path.join(root, afile)
+                if '_attachments' in path:
+                    tmp_path = list(path)
+                    tmp_path.remove('_attachments')
+                    tmp_path.append(afile)
+                    tmp_path = '/'.join(tmp_path)
+
+                    attach = self._attach(tmp_path, afile_path,
+                                          options.minify)
+                    attachments.update(attach)
+                else:
+                    key = afile
+                    if len(path) > 0 and path[0] in ['views', 'lists',
+                            'shows', 'filters'] and key.endswith('.js'):
+                        key = key[:-3]
+                    f = open(afile_path)
+                    insert(app, path, key, f.read())
+                    f.close()
 
         if attachments:
             app['_attachments'] = attachments
         return app
 
-    def _minify(self, file):
-        data = None
-        try:
-            f = open(file)
-            mini = jsmin(f.read())
-            data = base64.encodestring(mini)
-            f.close()
-        except:
-            msg = "Could not minify %s, uploading expanded version"
-            self.logger.debug(msg % file)
-            data = base64.encodestring(open(file).read())
-        return data
+    def _report_minify(self):
+        """
+        Log how many bytes minifying saved for each type of file.
+        """
+        if self.minify_saved:
+            saved = sorted(self.minify_saved.items())
+            self.logger.info('minifying saved %s bytes (%s)' % (
+                        sum([s for t, s in saved]),
+                        ', '.join(['%s %s' % (t, s) for t, s in saved])))
+        self.minify_saved.clear()
+
+    def _time(self, name, began):
+        """
+        Record how long a step of the push took, for the timings report.
+        """
+        self.timings.append((name, time.time() - began))
 
-    def _process_url(self, url):
-        """ Extract auth credentials from url, if present """
-        parts = urlparse(url)
-        if not parts.username and not parts.password:
-            return url, None
-        if parts.port:
-            netloc = '%s:%s' % (parts.hostname, parts.port)
+    def _build_designs(self, options, names=None):
+        """
+        Build the design docs of the application, all of them unless a
+        design was picked with -d or names limits them.
+        """
+        began = time.time()
+        self.walk_time = 0
+        designs = os.path.join(options.root, '_design')
+        apps = []
+        if os.path.exists(designs):
+            list_of_designs = os.listdir(designs)
+
+            if len(options.design) > 1:
+                list_of_designs = [options.design[1]]
+            if names is not None:
+                list_of_designs = [design for design in list_of_designs
+                                   if design in names]
+            matcher = self._matcher(options.root)
+            matcher.load(options.root, '')
+            matcher.load(designs, '_design')
+            for design in sorted(list_of_designs):
+                if matcher.ignored('_design/%s' % design, True):
+                    continue
+                name = os.path.join('_design', design)
+                root = os.path.join(designs, design)
+                app = self._walk_design(name, root, options)
+                apps.append(app)
+            self._prepare(apps)
+        self.timings.append(('walk', self.walk_time))
+        self._time('build', began)
+        self.logger.debug('built %s design docs using %s jobs' % (len(apps),
+                                                                options.jobs))
+        return apps
+
+    def _workers(self):
+        """
+        The pool of options.jobs processes that load docs and prepare
+        attachments, or None when there's only one job. The pool is started
+        on first use and kept until _close_workers, so call this before
+        starting any threads.
+        """
+        if self.options.jobs < 2:
+            return None
+        if getattr(self, 'workers', None) is None:
+            self.workers = multiprocessing.Pool(self.options.jobs)
+        return self.workers
+
+    def _close_workers(self):
+        if getattr(self, 'workers', None) is not None:
+            self.workers.close()
+            self.workers.join()
+            self.workers = None
+
+    def _iter_docs(self, options, names=None):
+        """
+        Yield the docs (and their attachments) in the _docs directory and
+        the directories below it, or only those whose path relative to _docs
+        is in names. A directory next to a .json file holds the attachments
+        of that doc; any other directory is searched for more docs. Docs are
+        read load_batch_size at a time, in options.jobs processes, so the
+        whole directory never has to be in memory. Files in ndjson_extensions
+        hold a doc per line and are streamed a line at a time.
+        """
+        top = os.path.join(options.root, '_docs')
+        if not os.path.exists(top):
+            return
+        self.load_time = 0
+        window = []
+        for root, dirs, files in self._walk(top, options.root):
+            rel = os.path.relpath(root, top).split(os.sep)
+            if rel == [os.curdir]:
+                rel = []
+            for file in files:
+                key = '/'.join(rel + [file])
+                if names is not None and key not in names:
+                    continue
+                if file.endswith(self.ndjson_extensions):
+                    # keep the docs in order
+                    for doc in self._load_window(window, options):
+                        yield doc
+                    window = []
+                    for doc in self._read_ndjson(os.path.join(root, file)):
+                        yield doc
+                    continue
+                if not file.endswith('.json'):
+                    continue
+                att_dir = None
+                if file[:-5] in dirs:
+                    att_dir = os.path.join(root, file[:-5])
+                window.append((key, os.path.join(root, file), att_dir))
+                if len(window) >= self.load_batch_size:
+                    for doc in self._load_window(window, options):
+                        yield doc
+                    window = []
+            # attachment directories aren't searched for docs
+            dirs[:] = [d for d in dirs if '%s.json' % d not in files]
+        for doc in self._load_window(window, options):
+            yield doc
+        self.timings.append(('load docs', self.load_time))
+
+    def _load_window(self, window, options):
+        """
+        Load the docs in window, a list of (key, path, attachment directory)
+        tuples, returning them ready to push.
+        """
+        began = time.time()
+        workers = self._workers()
+        paths = [path for key, path, att_dir in window]
+        if workers and len(paths) > 1:
+            loaded = workers.map(load_json, paths,
+                                 max(1, len(paths) / (options.jobs * 4)))
         else:
-            netloc = parts.hostname
-        url_tuple = (
-                    parts.scheme,
-                    netloc,
-                    parts.path,
-                    parts.params,
-                    parts.query,
-                    parts.fragment
-                    )
-        url = urlunparse(url_tuple)
-        if parts.username and parts.password:
-            auth_tuple = (parts.username, parts.password)
-            auth = base64.encodestring('%s:%s' % auth_tuple).strip()
-            return url, "%s" % auth
+            loaded = map(load_json, paths)
+        docs = []
+        for (key, file_path, att_dir), doc in zip(window, loaded):
+            if doc is None:
+                self.logger.info('could not read %s' % key)
+                continue
+            if att_dir:
+                att = {}
+                for path, dirs, files in self._walk(att_dir, options.root):
+                    # attachments are only taken from the top level
+                    del dirs[:]
+                    for a in files:
+                        fp = os.path.join(att_dir, a)
+                        att.update(self._attach(a, fp, options.minify))
+                doc['_attachments'] = att
+            docs.append(doc)
+        self._prepare(docs)
+        self.load_time += time.time() - began
+        return docs
+
+    def _changed(self, paths, root):
+        """
+        Work out which design docs and docs the changed paths belong to.
+        Returns the design names and doc paths (relative to _docs), either of
+        which is None if all of them need building again.
+        """
+        designs, docs = set(), set()
+        for path in paths:
+            parts = os.path.relpath(path, root).split(os.sep)
+            if parts[-1] == IgnoreMatcher.filename:
+                # read the ignore files afresh when rebuilding
+                self.matcher = None
+            if parts[-1] != IgnoreMatcher.filename and \
+                                    not self._allowed_file(parts[-1]):
+                continue
+            if len(parts) < 2 or parts[1] == IgnoreMatcher.filename or \
+                    parts[0] == '_docs' and parts[-1] == IgnoreMatcher.filename:
+                if parts[0] == '_design':
+                    designs = None
+                else:
+                    docs = None
+            elif parts[0] == '_design' and designs is not None:
+                designs.add(parts[1])
+            elif parts[0] == '_docs' and docs is not None:
+                rel = parts[1:]
+                name = '/'.join(rel)
+                for i in range(1, len(rel)):
+                    if os.path.exists('%s.json' % os.path.join(root, '_docs',
+                                                              *rel[:i])):
+                        # an attachment of that doc
+                        name = '/'.join(rel[:i])
+                        break
+                if not name.endswith(('.json',) + self.ndjson_extensions):
+                    name = '%s.json' % name
+                docs.add(name)
+        return designs, docs
+
+    def _watch(self, options, servers):
+        """
+        Push the design docs and docs that change until interrupted. The
+        connections made by the first push are kept open and reused.
+        """
+        dirs = [os.path.join(options.root, d) for d in ['_design', '_docs']]
+        dirs = [d for d in dirs if os.path.isdir(d)]
+        changes = watcher(dirs, options.watch_interval)
+        self.logger.info('watching %s for changes (%s), ctrl-c to stop' % (
+                            options.root, changes.__class__.__name__))
+        try:
+            while True:
+                designs, docs = self._changed(changes.changes(),
+                                              options.root)
+                if designs == set() and docs == set():
+                    # only ignored files changed
+                    continue
+                began = time.time()
+                self.timings = []
+                pushed = 0
+                if designs is None or designs:
+                    apps = self._build_designs(options, designs)
+                    if apps:
+                        results = self._push_docs(apps, options.database,
+                                                  servers)
+                        self._report(results)
+                        pushed += sum([r.docs for r in results.values()])
+                if docs is None or docs:
+                    loaded = list(self._iter_docs(options, docs))
+                    if loaded:
+                        results = self._push_docs(loaded, options.database,
+                                                  servers)
+                        self._report(results)
+                        pushed += sum([r.docs for r in results.values()])
+                self.logger.info('pushed %s changed docs in %.2fs' % (
+                                    pushed, time.time() - began))
+                self._report_minify()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            changes.close()
+
+    def _read_ndjson(self, path):
+        """
+        Yield the docs in a file with one JSON doc per line, such as an
+        artifact written by the build command, a line at a time. Inline
+        attachments are turned into Attachments, so they're uploaded just as
+        they would be from files. Lines that aren't JSON objects, or whose
+        attachments aren't, are logged and skipped.
+        """
+        if path.endswith('.gz'):
+            f = gzip.open(path, 'rb')
         else:
-            auth_tuple = (parts.username, getpass.getpass())
-            auth = base64.encodestring('%s:%s' % auth_tuple).strip()
-            return url, "%s" % auth
+            f = open(path, 'rb')
+        try:
+            for number, line in enumerate(f):
+                if not line.strip():
+                    continue
+                try:
+                    doc = json.loads(line)
+                except ValueError:
+                    doc = None
+                attachments = isinstance(doc, dict) and \
+                                doc.get('_attachments', {})
+                if not isinstance(attachments, dict) or \
+                        not all(isinstance(att, dict)
+                                for att in attachments.values()):
+                    self.logger.warning('could not read %s line %s' % (
+                                            path, number + 1))
+                    continue
+                for name, att in attachments.items():
+                    if 'data' in att:
+                        data = base64.b64decode(att['data'])
+                        attachments[name] = Attachment(None,
+                                                       att['content_type'],
+                                                       data)
+                yield doc
+        finally:
+            f.close()
+
+    def _read_artifact(self, path):
+        """
+        Split an artifact into a list of its design docs and an iterator
+        over the rest of its docs, which the build command writes after the
+        design docs. Docs without an _id are data docs.
+        """
+        docs = self._read_ndjson(path)
+        designs = []
+        for doc in docs:
+            if not doc.get('_id', '').startswith('_design/'):
+                return designs, itertools.chain([doc], docs)
+            designs.append(doc)
+        return designs, docs
 
     def run_command(self, args, options):
         """
@@ -447,10 +2378,11 @@ class Push(Command):
         self.logger.debug("Running Push Command for application in %s" %
                 options.root)
 
-        docs = os.path.join(options.root, '_docs')
-        designs = os.path.join(options.root, '_design')
-        apps_to_push = []
-        attachments_to_push = []
+        self.options = options
+        self.pool = ConnectionPool(options.timeout)
+        self.timings = []
+        start = time.time()
+        pushed = 0
 
         saved_servers = {}
         servers_to_use = {}
@@ -467,69 +2399,195 @@ class Push(Command):
                     servers_to_use[server]["auth"] = auth
 
         if len(servers_to_use.keys()) > 0:
-            if os.path.exists(designs):
-                list_of_designs = os.listdir(designs)
-
-                if len(options.design) > 1:
-                    list_of_designs = [options.design[1]]
-                for design in filter(self._allowed_file, list_of_designs):
-                    name = os.path.join('_design', design)
-                    root = os.path.join(designs, design)
-                    app = self._walk_design(name, root, options)
-                    apps_to_push.append(app)
-
-            self._push_docs(apps_to_push, options.database, servers_to_use)
-
-            if os.path.exists(docs):
-                docs_to_push = defaultdict(dict)
-                l_dir = os.listdir(docs)
-                for file in filter(self._allowed_file, l_dir):
-                    file_path = os.path.join(docs, file)
-
-                    if file.endswith('.json'):
-                        # do something to check it's json
-                        try:
-                            f = open(file_path)
-                            docs_to_push[file].update(json.load(f))
-                            f.close()
-                        except:
-                            self.logger.info('could not read %s' % file)
-                    elif os.path.isdir(file_path) and \
-                                              '%s.json' % file in l_dir:
-                    # Assume directory contents are attachments
-                        attachments = os.listdir(file_path)
-                        key = '%s.json' % file
-                        att = {}
-                        for a in filter(self._allowed_file, attachments):
-                            fp = os.path.join(file_path, a)
-                            att.update(self._attach(a, fp, options.minify))
-                        docs_to_push[key].update({'_attachments': att})
-                self._push_docs(docs_to_push.values(), options.database,
-                        servers_to_use)
+            # start the worker processes before any threads
+            self._workers()
+            if options.from_artifact:
+                apps_to_push, docs_to_push = self._read_artifact(
+                                                    options.from_artifact)
+            else:
+                apps_to_push = self._build_designs(options)
+                docs_to_push = self._iter_docs(options)
+            began = time.time()
+            results = self._push_docs(apps_to_push, options.database,
+                                      servers_to_use)
+            self._time('push designs', began)
+            ok = self._report(results)
+            pushed += sum([r.docs for r in results.values()])
+
+            # docs are streamed to the servers as they're loaded
+            began = time.time()
+            first = next(docs_to_push, None)
+            if first is not None:
+                docs_to_push = itertools.chain([first], docs_to_push)
+                results = self._push_docs(docs_to_push, options.database,
+                                          servers_to_use)
+                self._time('push docs', began)
+                ok = self._report(results) and ok
+                pushed += sum([r.docs for r in results.values()])
+            elapsed = time.time() - start
+            self.logger.info('pushed %s docs in %.2fs (%.1f docs/s)' % (
+                                pushed, elapsed, pushed / max(elapsed, 0.001)))
+            self.logger.info('timings: %s' % ', '.join(['%s %.2fs' % t
+                                                       for t in self.timings]))
+            self._report_minify()
+            if options.watch and options.from_artifact:
+                self.logger.warning('--watch ignored when pushing an artifact')
+            elif options.watch:
+                self._watch(options, servers_to_use)
+            self._close_workers()
+            self.pool.close()
+            self.logger.info(self.pool.summary())
+            if not ok:
+                sys.exit(1)
         else:
             self.logger.warning('No servers specified - add -s server_url')
 
 
+class Build(Push):
+    """
+    The Build command assembles the design docs and _docs of the application,
+    attachments and all, into an artifact file that push --from-artifact can
+    upload without the source tree. The artifact has one JSON doc per line,
+    with sorted keys, so the same app always builds the same artifact.
+    """
+    name = 'build'
+    no_required_args = 0
+
+    def _add_options(self):
+        """
+        Give the OptionParser additional options
+        """
+        about = "Options available to the build command."
+        group = OptionGroup(self.parser, "Build options", about)
+        group.add_option("-o", "--output",
+                dest="output", default="situp-build.ndjson",
+                help="Write the artifact to this file, gzipped if it ends "
+                     "in .gz, default situp-build.ndjson")
+        self._add_build_options(group)
+        self.parser.add_option_group(group)
+
+    def _write_artifact(self, docs, path):
+        """
+        Write docs to the artifact at path, streaming the attachments, and
+        return how many were written. The artifact is written to a temporary
+        file and renamed into place, or removed if writing fails.
+        """
+        tmp = '%s.tmp' % path
+        f = open(tmp, 'wb')
+        out = f
+        if path.endswith('.gz'):
+            # no file name or time in the header, to keep builds identical
+            out = gzip.GzipFile('', 'wb', 9, f, 0)
+        count = 0
+        try:
+            try:
+                for doc in docs:
+                    for chunk in iter_json(doc, sort_keys=True):
+                        out.write(chunk)
+                    out.write('\n')
+                    count += 1
+            finally:
+                if out is not f:
+                    out.close()
+                f.close()
+        except Exception:
+            os.remove(tmp)
+            raise
+        os.rename(tmp, path)
+        return count
+
+    def run_command(self, args, options):
+        """
+        Build the application and write it to the artifact
+        """
+        self.logger.debug("Running Build Command for application in %s" %
+                options.root)
+        self.options = options
+        self.timings = []
+        docs = itertools.chain(self._build_designs(options),
+                               self._iter_docs(options))
+        began = time.time()
+        count = self._write_artifact(docs, options.output)
+        self._time('write', began)
+        self._close_workers()
+        self.logger.info('built %s docs into %s' % (count, options.output))
+        self.logger.info('timings: %s' % ', '.join(['%s %.2fs' % t
+                                                   for t in self.timings]))
+        self._report_minify()
+
+
 class Fetch(Command):
     """
     Copy a remote CouchApp into the working directory.
     """
     name = 'fetch'
+    # how many docs to ask _all_docs for at a time
+    page_size = 500
 
     def _add_options(self):
         group = OptionGroup(self.parser, "Fetch options", "")
+        group.add_option("--ndjson",
+                dest="ndjson", default=None, metavar="FILE",
+                help="Write the docs to FILE in _docs, one per line with "
+                     "their attachments inline, instead of a file per doc")
+        self.parser.add_option_group(group)
+
+    def _all_docs(self, pool, url, query, auth=False):
+        """
+        Yield the docs in the database at url, reading _all_docs page_size
+        rows at a time so that only one page is held in memory. Each page
+        starts after the last id of the one before it.
+        """
+        startkey = None
+        while True:
+            page = '%s/_all_docs?%s&limit=%s' % (url, query, self.page_size)
+            if startkey is not None:
+                page += '&startkey=%s&skip=1' % urllib.quote(
+                                                        json.dumps(startkey))
+            response = pool.request('GET', page, auth=auth)
+            if response.status != 200:
+                raise HTTPException('fetching docs failed: %s %s' % (
+                                            response.status, response.body))
+            rows = json.loads(response.body)['rows']
+            for row in rows:
+                yield row['doc']
+            if len(rows) < self.page_size:
+                return
+            startkey = rows[-1]['id']
+
+    def _inline_attachments(self, pool, url, docid, auth=False):
+        """
+        Fetch the attachments of the doc docid with their data inline. Pages
+        of _all_docs only hold stubs, so that no more than one doc's
+        attachments are in memory at a time.
+        """
+        response = pool.request('GET', '%s/%s?attachments=true' % (
+                                        url, urllib.quote(docid, safe='')),
+                                headers={'Accept': 'application/json'},
+                                auth=auth)
+        if response.status != 200:
+            raise HTTPException('fetching %s failed: %s %s' % (
+                                docid, response.status, response.body))
+        return json.loads(response.body)['_attachments']
 
     def run_command(self, args, options):
         """
         """
-        url = args[0]
-        d = json.load(urllib.urlopen('%s/_all_docs?include_docs=true' % url))
-        app = [d['doc'] for d in d['rows']]
+        url, auth = self._process_url(args[0])
+        pool = ConnectionPool()
+        app = self._all_docs(pool, url, 'include_docs=true', auth)
 
         if not os.path.exists('_docs'):
             os.mkdir('_docs')
         if not os.path.exists('_design'):
             os.mkdir('_design')
+        ndjson = None
+        if options.ndjson:
+            path = os.path.join('_docs', options.ndjson)
+            if path.endswith('.gz'):
+                ndjson = gzip.open(path, 'wb')
+            else:
+                ndjson = open(path, 'wb')
         for doc in app:
             # TODO: have _rev removal be optional
             # TODO: optionally filter out data or design docs
@@ -543,7 +2601,17 @@ class Fetch(Command):
                 path_elems = id.split('/')
                 path_elems.append('_attachments')
                 base_att_dir = os.path.join(*path_elems)
-
+            elif ndjson:
+                if attachments:
+                    attachments = self._inline_attachments(pool, url, id,
+                                                           auth)
+                    doc['_attachments'] = dict([(name, {
+                                    'content_type': att['content_type'],
+                                    'data': att['data']})
+                                    for name, att in attachments.items()])
+                ndjson.write(json.dumps(doc, sort_keys=True))
+                ndjson.write('\n')
+                continue
             else:
                 f = open(os.path.join('_docs', '%s.json' % id), 'w')
                 json.dump(doc, f)
@@ -555,7 +2623,16 @@ class Fetch(Command):
                     os.makedirs(att_dir)
 
                 a_file = str(os.path.join(att_dir, att.split('/')[-1]))
-                urllib.urlretrieve('%s/%s/%s' % (url, id, att), a_file)
+                if 'data' in attachments[att]:
+                    f = open(a_file, 'wb')
+                    f.write(base64.b64decode(attachments[att]['data']))
+                    f.close()
+                else:
+                    pool.download('%s/%s/%s' % (url, id, att), a_file, auth)
+        if ndjson:
+            ndjson.close()
+        pool.close()
+        self.logger.debug(pool.summary())
 
 
 class InstallVendor(Command):
@@ -944,8 +3021,9 @@ class FetchVendors(Generator):
 
 if __name__ == "__main__":
     cli = CommandDispatch()
-    for command in [AddServer, Push, Fetch, InstallVendor, View, ListGen, Show,
-            Document, Html, GitHook, Filter, Update, Validation]:
+    for command in [AddServer, Push, Build, Fetch, InstallVendor, View,
+            ListGen, Show, Document, Html, GitHook, Filter, Update,
+            Validation]:
         cli.register_command(command())
 
     if len(sys.argv) > 1 and sys.argv[1] in cli.commands.keys():
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import unittest
+import os
+import shutil
+from StringIO import StringIO
+from tempfile import mkdtemp
+
+# Code being tested:
+from minify import cssmin, htmlmin, UnterminatedComment
+from minify import UnterminatedStringLiteral, UnterminatedRegularExpression
+from minify import jsmin, JavascriptMinify, FastJavascriptMinify
+from minify import jsmin_iter, jsmangle, MinifyCache
+
+
+class FastJavascriptMinifyTest(unittest.TestCase):
+    """
+    Test the fast engine gives exactly what the original one does
+    """
+    samples = [
+        '',
+        'var  a = 1;\r\n// comment\nvar b\t= "a  \\" b" + \'c\';\n',
+        'function f(x) {\n  /* block\n comment */\n  return x / 2 / 1;\n}\n',
+        'var re = /a[/]b\\/c/g, s = x.replace( /\\s+/ , "");\n',
+        'if (a)\n{\n  b++\n}\nelse\n  [1, 2].map(f)\n-c\n',
+        'a = b\n/ c /\n d',
+        'x = 1 /',
+        'y = "caf\xc3\xa9"   +\x00\x01 $z',
+        u'z = "\xe9t\xe9" ;',
+    ]
+
+    def original(self, js):
+        outs = StringIO()
+        JavascriptMinify().minify(StringIO(js), outs)
+        return outs.getvalue()
+
+    def testSameOutput(self):
+        for js in self.samples:
+            self.assertEquals(self.original(js),
+                              FastJavascriptMinify().minify_string(js))
+
+    def testSameErrors(self):
+        for js, error in [('a = "b', UnterminatedStringLiteral),
+                          ('a = "b\\', UnterminatedStringLiteral),
+                          ('a = "b\nc"', UnterminatedStringLiteral),
+                          ('a /* b', UnterminatedComment),
+                          ('a = /b', UnterminatedRegularExpression),
+                          ('a = (/b\n/)', UnterminatedRegularExpression)]:
+            self.assertRaises(error, self.original, js)
+            self.assertRaises(error, FastJavascriptMinify().minify_string,
+                              js)
+
+    def testChunks(self):
+        # a chunk at a time, however the input is split up
+        for js in self.samples:
+            for size in [1, 2, 3, 7]:
+                chunks = [js[i:i + size] for i in range(0, len(js), size)]
+                self.assertEquals(
+                    self.original(js),
+                    ''.join(FastJavascriptMinify().minify_iter(chunks)))
+        js = 'a = "b\\'
+        self.assertRaises(UnterminatedStringLiteral, list,
+                          FastJavascriptMinify().minify_iter(list(js)))
+        # a '*' that starts a comment can't end it too
+        self.assertRaises(UnterminatedComment, list,
+                          FastJavascriptMinify().minify_iter(['a /*', '/']))
+
+    def testStreams(self):
+        minifier = FastJavascriptMinify()
+        minifier.chunk_size = 5
+        js = self.samples[2] * 3
+        outs = StringIO()
+        minifier.minify(StringIO(js), outs)
+        self.assertEquals(self.original(js), outs.getvalue())
+
+    def testJsmin(self):
+        self.assertEquals('{a();}', jsmin('{\n  a();\n}\n'))
+        self.assertEquals('{a();}', ''.join(jsmin_iter(['{\n  a', '();\n}'])))
+
+
+class JsMangleTest(unittest.TestCase):
+    """
+    Test local variables are renamed, and nothing else is
+    """
+    def testLocals(self):
+        js = 'var top = 1;\n' \
+             'function outer(first, second) {\n' \
+             '  var obj = {first: first, get second() { return second; }};\n' \
+             '  try { obj.first(top) } catch (err) { return err.message }\n' \
+             '  loop: for (var i in obj) { if (i) continue loop; }\n' \
+             '  return first ? /\\/first/ : "second";\n' \
+             '}\n'
+        self.assertEquals('var top=1;function outer(a,d){'
+                          'var b={first:a,get second(){return d;}};'
+                          'try{b.first(top)}catch(a){return a.message}\n'
+                          'loop:for(var c in b){if(c)continue loop;}\n'
+                          'return a?/\\/first/:"second";}',
+                          jsmangle(js))
+
+    def testOuterNamesKept(self):
+        # a is global and b is outer's, so inner can't use either
+        js = 'function outer(long) {\n' \
+             '  return function inner(x, y) { return a + long + x + y; };\n' \
+             '}\n'
+        self.assertEquals('function outer(b){return function e(c,d){'
+                          'return a+b+c+d;};}', jsmangle(js))
+
+    def testRegexAfterParens(self):
+        # after the head of an if a / starts a regex, elsewhere it divides
+        js = "function f(re, y) { if (y) /re/.test('re') && (y = 2);" \
+             " return (re) / y / 2; }"
+        self.assertEquals("function f(b,a){if(a)/re/.test('re')&&(a=2);"
+                          "return(b)/a/2;}", jsmangle(js))
+
+    def testEvalAndWith(self):
+        for js in ['function f(x) { return eval("x"); }',
+                   'function f(x) { with (x) { return y; } }',
+                   'function f(x) { return function () { eval(""); }; }']:
+            self.assertEquals(jsmin(js), jsmangle(js))
+        # the function around x doesn't use eval, so x can be renamed
+        self.assertEquals('function f(){eval("");return function(a){};}',
+                          jsmangle('function f() { eval("");'
+                                   ' return function (x) {}; }'))
+
+    def testNewerJavascript(self):
+        for js in ['function f(x) { let y = x; return y; }',
+                   'function f(x) { return x.map(y => y * 2); }',
+                   'function f(x) { return `${x}`; }',
+                   'function f(x) { return {x}; }']:
+            self.assertEquals(jsmin(js), jsmangle(js))
+
+
+class MinifyCacheTest(unittest.TestCase):
+    """
+    Test minified content is stored by content and minifier
+    """
+    def setUp(self):
+        self.path = mkdtemp()
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def counting(self, minifier):
+        def minify(content):
+            self.calls.append(content)
+            return minifier(content)
+        minify.__name__ = minifier.__name__
+        return minify
+
+    def testStored(self):
+        cache = MinifyCache(os.path.join(self.path, 'store'))
+        js = self.counting(jsmin)
+        css = self.counting(cssmin)
+        self.assertEquals('var a=1;', cache.minify(js, 'var  a = 1;'))
+        self.assertEquals('var a=1;', cache.minify(js, 'var  a = 1;'))
+        self.assertEquals('var a = 1;', cache.minify(css, 'var  a = 1;'))
+        self.assertEquals(['var  a = 1;', 'var  a = 1;'], self.calls)
+        self.assertEquals(2, len(os.listdir(cache.path)))
+
+    def testFile(self):
+        path = os.path.join(self.path, 'a.js')
+        f = open(path, 'w')
+        f.write('var  a = 1;')
+        f.close()
+        cache = MinifyCache(os.path.join(self.path, 'store'))
+        js = self.counting(jsmin)
+        self.assertEquals('var a=1;', cache.minify_file(js, path, jsmin_iter))
+        self.assertEquals('var a=1;', cache.minify(js, 'var  a = 1;'))
+        self.assertEquals('var a=1;', cache.minify_file(js, path))
+        # the generator did the work, and it was stored for the others
+        self.assertEquals([], self.calls)
+
+    def testErrorsNotStored(self):
+        cache = MinifyCache(self.path)
+        self.assertRaises(UnterminatedComment, cache.minify, jsmin, 'a /*')
+        self.assertEquals([], os.listdir(self.path))
+
+    def testEvict(self):
+        cache = MinifyCache(self.path, 20)
+        for i in range(5):
+            cache.minify(jsmin, 'var  a%s = 1;' % i)
+        cache.evict()
+        self.assertEquals(2, len(os.listdir(self.path)))
+
+
+class CssMinTest(unittest.TestCase):
+    """
+    Test CSS is minified without changing what it means
+    """
+    def testWhitespaceAndComments(self):
+        css = '/* header */\na  b , c > d {\n  color: red ;\n  margin: 0;\n}\n'
+        self.assertEquals('a b,c>d{color:red;margin:0}', cssmin(css))
+
+    def testSignificantSpacesKept(self):
+        css = 'a :hover { width: calc(1px + 2px) !important }\n' \
+              '@media screen and (max-width: 10px) { p { margin: 0 } }'
+        self.assertEquals('a :hover{width:calc(1px + 2px) !important}'
+                          '@media screen and (max-width:10px){p{margin:0}}',
+                          cssmin(css))
+
+    def testStrings(self):
+        css = 'a { content: "/* not  a comment */" }'
+        self.assertEquals('a{content:"/* not  a comment */"}', cssmin(css))
+
+    def testErrors(self):
+        self.assertRaises(UnterminatedComment, cssmin, 'a { } /* oops')
+        self.assertRaises(UnterminatedStringLiteral, cssmin, 'a { b: "c }')
+
+
+class HtmlMinTest(unittest.TestCase):
+    """
+    Test HTML is minified without changing what it means
+    """
+    def testWhitespaceAndComments(self):
+        html = '<html>\n  <!-- comment -->\n  <p title="a  b">x   y</p>\n' \
+               '</html>\n'
+        self.assertEquals('<html> <p title="a  b">x y</p> </html>',
+                          htmlmin(html))
+
+    def testVerbatim(self):
+        html = '<pre>  a\n   b</pre> <script>\nvar  a;\n</script>' \
+               '<!--[if IE]><p>ie</p><![endif]-->'
+        self.assertEquals(html, htmlmin(html))
+
+    def testErrors(self):
+        self.assertRaises(UnterminatedComment, htmlmin, '<p><!-- oops')
+
+
+if __name__ == '__main__':
+    unittest.main()